@@ -0,0 +1,3229 @@
+import abc
+import bisect
+import itertools
+import keyword
+import operator
+import six
+import sys
+import threading
+import time
+import types
+import warnings
+import weakref
+from collections import defaultdict, OrderedDict
+
+class p_kind():
+    "Kinds of parameters, same values as in `inspect.Parameter` (importing inspect takes longer than all of fpm)."
+    POSITIONAL_ONLY = 0
+    POSITIONAL_OR_KEYWORD = 1
+    VAR_POSITIONAL = 2
+    KEYWORD_ONLY = 3
+    VAR_KEYWORD = 4
+
+# GENERAL #
+
+strict_guard_definitions = True # only instances of GuardFunc and RelGuard can be used as guards.
+                                # if set to False, then any callable is allowed, but may cause unexpected behaviour.
+_guard_mode = ('on', 100, None) # (mode, every, report) followed by guarded functions, see `set_guard_mode`.
+_guard_mode_lock = threading.Lock()
+_guarded_functions = weakref.WeakSet() # recompiled when global guard mode changes
+defer_validation = False # if set to True, guard definitions are checked on first call of guarded function (or when
+                         # it's first dispatched to by a MultiFunc), or by `finalize()`, instead of on decoration.
+
+class GuardError(Exception):
+    "Guard haven't let argument pass."
+    pass
+
+class MatchError(Exception):
+    """
+    No match for function call. If raised by a call of multi-claused function, `explain()` tells why each clause
+    didn't match.
+    """
+    func = None # MultiFunc which raised it, arguments of the call are in `call_args` and `call_kwargs`
+
+    def explain(self):
+        "Returns `func.explain` for the call which raised it, or None if unknown."
+        if self.func is None:
+            return None
+        return self.func.explain(*self.call_args, **self.call_kwargs)
+
+class WontMatchError(Exception):
+    "Case declared after catch-all or identical case."
+    pass
+
+class MixedPatternDefinitionError(Exception):
+    "Raised when pattern is defined both as `case` arguments and function defaults."
+    pass
+
+class _():
+    """The "don't care" value."""
+    def __repr__(self):
+        return "_"
+    def __call__(*args, **kwargs):
+        return True
+_ = _() # we need just one and only one instance.
+
+# GUARDS #
+
+class _ArgSpec(object):
+    "Arguments specification, like the one `inspect.getfullargspec` returns."
+    __slots__ = ('args', 'varargs', 'kwonlyargs', 'varkw', 'defaults', 'kwonlydefaults', 'annotations',
+                 'posonlycount')
+
+    def __init__(self, args, varargs, kwonlyargs, varkw, defaults, kwonlydefaults, annotations, posonlycount=0):
+        self.args = args # positional-only ones first, `posonlycount` of them
+        self.posonlycount = posonlycount
+        self.varargs = varargs
+        self.kwonlyargs = kwonlyargs
+        self.varkw = varkw
+        self.defaults = defaults
+        self.kwonlydefaults = kwonlydefaults
+        self.annotations = annotations
+
+    @property
+    def keywords(self):
+        "getargspec compat"
+        return self.varkw
+
+_code_args = weakref.WeakKeyDictionary() # code object -> (args, varargs, kwonlyargs, varkw)
+
+def _code_arg_names(code):
+    "Returns `(args, varargs, kwonlyargs, varkw)` names of arguments of code object, cached."
+    try:
+        return _code_args[code]
+    except KeyError:
+        pass
+    names = code.co_varnames
+    argcount = code.co_argcount
+    kwonlycount = getattr(code, 'co_kwonlyargcount', 0) # py2
+    end = argcount + kwonlycount
+    varargs = varkw = None
+    if code.co_flags & 0x04: # CO_VARARGS
+        varargs = names[end]
+        end += 1
+    if code.co_flags & 0x08: # CO_VARKEYWORDS
+        varkw = names[end]
+    arg_names = _code_args[code] = (names[:argcount], varargs, names[argcount:argcount + kwonlycount], varkw)
+    return arg_names
+
+def _getfullargspec_p(func):
+    """
+    Gets uniform full arguments specification of func, portably.
+
+    Argument names of plain functions are read from their code object (and cached per code object, so that `guard`
+    and `case` share them), other callables go through `inspect.signature`.
+    """
+    if (type(func) is types.FunctionType and not hasattr(func, '__wrapped__')
+            and not hasattr(func, '__signature__')):
+        args, varargs, kwonlyargs, varkw = _code_arg_names(func.__code__)
+        return _ArgSpec(args, varargs, kwonlyargs, varkw, func.__defaults__,
+                        dict(getattr(func, '__kwdefaults__', None) or {}),
+                        dict(getattr(func, '__annotations__', None) or {}),
+                        getattr(func.__code__, 'co_posonlyargcount', 0)) # py<3.8
+
+    import inspect
+    try:
+        sig = inspect.signature(func)
+        sig_params = sig.parameters
+    except AttributeError: # signature method not available
+        # try getfullargspec is present (pre 3.3)
+        try:
+            return inspect.getfullargspec(func)
+        except AttributeError: # getfullargspec method not available
+            return inspect.getargspec(func) # py2, trying annotations will fail.
+
+    # continue conversion for py >=3.3
+    def _arg_spec_helper(kinds=(), defaults=False, kwonlydefaults=False, annotations=False):
+        for arg_name, param in sig_params.items():
+            if not defaults and not kwonlydefaults and not annotations and param.kind in kinds:
+                yield arg_name
+            elif sum((defaults, kwonlydefaults, annotations)) > 1:
+                raise ValueError("Only one of 'defaults', 'kwonlydefaults' or 'annotations' can be True simultaneously")
+            elif annotations and param.annotation is not inspect._empty:
+                yield (arg_name, param.annotation)
+            elif param.default is not inspect._empty:
+                if defaults and param.kind in (p_kind.POSITIONAL_OR_KEYWORD, p_kind.POSITIONAL_ONLY):
+                    yield param.default
+                elif kwonlydefaults and param.kind == p_kind.KEYWORD_ONLY:
+                    yield (arg_name, param.default)
+
+    varargs = six.next(_arg_spec_helper((p_kind.VAR_POSITIONAL,)), None)
+    varkw = six.next(_arg_spec_helper((p_kind.VAR_KEYWORD,)), None)
+    arg_spec = _ArgSpec(
+            tuple(_arg_spec_helper((p_kind.POSITIONAL_OR_KEYWORD, p_kind.POSITIONAL_ONLY))), varargs,
+            tuple(_arg_spec_helper((p_kind.KEYWORD_ONLY,))), varkw,
+            tuple(_arg_spec_helper(defaults=True)) or None,
+            dict(_arg_spec_helper(kwonlydefaults=True)),
+            dict(_arg_spec_helper(annotations=True)),
+            sum(param.kind == p_kind.POSITIONAL_ONLY for param in sig_params.values()))
+    if sig.return_annotation is not inspect._empty:
+        arg_spec.annotations['return'] = sig.return_annotation
+
+    return arg_spec
+
+def _getparams(func):
+    """Get tuple of arg name and kind pairs."""
+
+    arg_spec = _getfullargspec_p(func)
+
+    # create tuples for each kind
+    args = tuple((arg, p_kind.POSITIONAL_OR_KEYWORD) for arg in arg_spec.args)
+    varargs = ((arg_spec.varargs, p_kind.VAR_POSITIONAL),) if arg_spec.varargs else ()
+    try:
+        kwonlyargs = tuple((arg, p_kind.KEYWORD_ONLY) for arg in arg_spec.kwonlyargs)
+    except AttributeError: # python2
+        kwonlyargs = ()
+    varkw = ((arg_spec.varkw, p_kind.VAR_KEYWORD),) if arg_spec.keywords else ()
+
+    return args + varargs + kwonlyargs + varkw
+
+def _iscoroutinefunction(fun):
+    "Like `inspect.iscoroutinefunction`, but plain functions are checked without importing inspect."
+    if type(fun) is types.FunctionType and not hasattr(fun, '_is_coroutine_marker'):
+        return bool(fun.__code__.co_flags & 0x80) # CO_COROUTINE
+    import inspect
+    return getattr(inspect, 'iscoroutinefunction', lambda fun: False)(fun) # py<3.5 has no coroutines
+
+def _is_async(grd):
+    "Checks if guard, relguard or clause has to be awaited: if it's a coroutine function or has one in its tree."
+    if isinstance(grd, GuardFunc):
+        if grd.op == 'test':
+            return _iscoroutinefunction(grd.operands[0])
+        return any(_is_async(operand) for operand in grd.operands if isinstance(operand, GuardFunc))
+    if isinstance(grd, RelGuard):
+        return _iscoroutinefunction(grd.test)
+    return _iscoroutinefunction(grd)
+
+def _fresh_name(base, taken):
+    "Returns `base` suffixed with as many underscores as needed to avoid clashing with `taken` and reserves it."
+    while base in taken:
+        base += '_'
+    taken.add(base)
+    return base
+
+class _Source():
+    """
+    Helper for generating code. Keeps track of names already used in generated function, and of the namespace the
+    function will be compiled in.
+    """
+    def __init__(self, namespace, taken=()):
+        self.namespace = namespace
+        self.taken = set(taken)
+        self._injected = {} # id(value) -> name; the value itself is kept alive by namespace, so id won't be reused.
+
+    def name(self, base):
+        "Reserves a local variable name."
+        return _fresh_name(base, self.taken)
+
+    def inject(self, base, value):
+        "Puts value into namespace under a name that can't be shadowed by the generated function's locals."
+        try:
+            return self._injected[id(value)]
+        except KeyError:
+            name = self._injected[id(value)] = _fresh_name(base, self.taken)
+            self.namespace[name] = value
+            return name
+
+    def compile(self, fun_name, signature, body, filename, is_async=False):
+        "Compiles function (a coroutine function if `is_async` is set) from its signature and body lines, and returns it."
+        source = '%sdef %s(%s):\n    %s\n' % ('async ' if is_async else '', fun_name, signature, '\n    '.join(body))
+        six.exec_(compile(source, filename, 'exec'), self.namespace)
+        return self.namespace[fun_name]
+
+def _load_global(module, qualname):
+    "Imports module and returns object under qualified name in it. Used to unpickle guards shadowing their tests."
+    __import__(module)
+    obj = sys.modules[module]
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+def _global_name(obj, test):
+    """
+    Returns `(module, qualname)` of `test` function if `obj` can be found under that name instead (like a guard made
+    with a decorator, which shadows its test), or None.
+    """
+    module = getattr(test, '__module__', None)
+    qualname = getattr(test, '__qualname__', getattr(test, '__name__', None))
+    if module not in sys.modules or not qualname:
+        return None
+    try:
+        found = sys.modules[module]
+        for name in qualname.split('.'):
+            found = getattr(found, name)
+    except AttributeError:
+        return None
+    return (module, qualname) if found is obj else None
+
+class _compiled_on_access(object):
+    """
+    Descriptor which compiles guard the first time its `test` (or relguard its `_call`) is needed. The result is
+    cached as an instance attribute, which shadows the descriptor from then on.
+    """
+    def __init__(self, name='test'):
+        self.name = name
+
+    def __get__(self, grd, owner):
+        if grd is None:
+            return self
+        compiled = grd.compile()
+        setattr(grd, self.name, compiled)
+        return compiled
+
+class GuardFunc(object):
+    """
+    Class for guard functions. It checks if function to wrap is defined correctly, returns boolean, doesn't raise
+    unwanted TypeErrors and allows creating new guards by combining then with logical operators.
+
+    Guards are nodes of an expression tree: `op` names the operation and `operands` holds either its arguments (for
+    leaves, like the value `eq` compares with) or child nodes (for `&`, `|`, `^` and `~`). The whole tree is
+    compiled to a single function when the guard is called for the first time.
+    """
+
+    test = _compiled_on_access()
+    cost = None # estimated cost of test, see `_cost`
+
+    def __init__(self, test, cost=None):
+        if not callable(test):
+            raise ValueError("Guard test has to be callable")
+
+        # check if test signature is ok
+        test_args = _getparams(test)
+
+        if len(tuple(arg for arg in test_args
+                     if arg[1] in (p_kind.POSITIONAL_ONLY, p_kind.POSITIONAL_OR_KEYWORD))) != 1:
+            raise ValueError("Guard test has to have only one positional (not varying) argument")
+
+        self.op = 'test'
+        self.operands = (test,)
+        if cost is not None:
+            self.cost = cost
+
+    @classmethod
+    def _node(cls, op, *operands):
+        "Creates a tree node. Operands are not checked, so this is only for guards defined in this module."
+        node = cls.__new__(cls)
+        node.op = op
+        node.operands = operands
+        return node
+
+    def _isotherguard(method):
+        """Checks if `other` is a GuardFunc object. `_` is accepted too, as it's a guard which lets anything pass."""
+
+        @six.wraps(method)
+        def checks(self, other):
+            if other is _:
+                other = GuardFunc._node('_')
+            elif not isinstance(other, GuardFunc):
+                raise TypeError("The right-hand operand has to be instance of GuardFunc")
+            return method(self, other)
+
+        return checks
+
+    def __invert__(self):
+        """
+        ~ operator
+        """
+        return GuardFunc._node('not', self)
+
+    @_isotherguard
+    def __and__(self, other):
+        """
+        & operator
+        """
+        return GuardFunc._node('and', self, other)
+
+    @_isotherguard
+    def __or__(self, other):
+        """
+        | operator
+        """
+        return GuardFunc._node('or', self, other)
+
+    @_isotherguard
+    def __xor__(self, other):
+        """
+        ^ operator
+        """
+        return GuardFunc._node('xor', self, other)
+
+    def __call__(self, inp):
+        """Forward call to `self.test`"""
+        return self.test(inp)
+
+    def __reduce__(self):
+        """
+        Guards are pickled by structure, without compiled test. Guards made with `makeguard` decorator are pickled
+        by name of their test function instead, as the guard shadows it.
+        """
+        if self.op == 'test':
+            name = _global_name(self, self.operands[0])
+            if name is not None:
+                return (_load_global, name)
+            if self.cost is not None:
+                return (_guard_node, (self.op,) + tuple(self.operands), {'cost': self.cost})
+        return (_guard_node, (self.op,) + tuple(self.operands))
+
+    def __repr__(self):
+        if self.op in _guard_operators:
+            return '(%s)' % (' %s ' % _guard_operators[self.op]).join(map(repr, self.operands))
+        elif self.op == 'not':
+            return '~%r' % self.operands[0]
+        elif self.op == '_':
+            return '_'
+        elif self.op == 'test':
+            return getattr(self.operands[0], '__name__', 'makeguard(%r)' % self.operands[0])
+        else:
+            return '%s(%s)' % (self.op, ', '.join(map(repr, self.operands)))
+
+    def compile(self):
+        """
+        Compiles guard expression tree to a single function of one argument, which returns boolean.
+
+        Tree is simplified first: nested `&` and `|` are flattened and short-circuited, redundant `_` nodes dropped,
+        lower and upper bound on input folded to a chained comparison, and `In` on a tuple of hashable values turned
+        to a frozenset lookup (lists may change later, so they're scanned).
+        """
+        src = _Source({}, ('inp',))
+        result = src.name('passed')
+        body = _guard_statements(src, _simplify(self), 'inp', result) + ['return %s' % result]
+        return src.compile('guard', 'inp', body, '<guard>', is_async=_is_async(self))
+
+    def mask(self, values):
+        """
+        Evaluates guard on every element of `values` (NumPy array or any iterable) at once and returns NumPy array of
+        booleans. Built-in guards on numeric and string arrays map to vectorized NumPy operations, the rest is
+        evaluated element by element. Elements are what iterating the array gives, i.e. NumPy scalars such as
+        `numpy.int64`, which `isoftype(int)` doesn't match (`isoftype(numpy.integer)` does). Requires NumPy.
+        """
+        import numpy
+        if _is_async(self):
+            raise TypeError("Async guards can't be evaluated on arrays")
+        values = _as_array(numpy, values)
+        return _mask(numpy, _simplify(self), values.reshape(-1)).reshape(values.shape)
+
+_guard_operators = {'and': '&', 'or': '|', 'xor': '^'}
+
+def _guard_node(op, *operands):
+    "Recreates a guard tree node, when unpickling."
+    return GuardFunc._node(op, *operands)
+
+def makeguard(decoratee=None, cost=None):
+    """
+    Decorator which turns decoratee to GuardFunc object. Use as `makeguard(cost=...)` to hint how expensive the test
+    is, relative to a comparison costing about 2 (custom guards without a hint cost 10).
+    """
+    if decoratee is None:
+        return lambda decoratee: GuardFunc(decoratee, cost)
+    return GuardFunc(decoratee, cost)
+
+def eq(val):
+    "Is inp equal to val."
+    return GuardFunc._node('eq', val)
+def ne(val):
+    "Is inp not equal to val."
+    return GuardFunc._node('ne', val)
+def lt(val):
+    "Is inp less than val."
+    return GuardFunc._node('lt', val)
+def le(val):
+    "Is inp less than or equal to val."
+    return GuardFunc._node('le', val)
+def gt(val):
+    "Is inp greater than val."
+    return GuardFunc._node('gt', val)
+def ge(val):
+    "Is inp greater than or equal to val"
+    return GuardFunc._node('ge', val)
+
+def Is(val):
+    "Is inp the same object as val."
+    return GuardFunc._node('Is', val)
+def Isnot(val):
+    "Is inp different object than val."
+    return GuardFunc._node('Isnot', val)
+
+def isoftype(*types):
+    "Is inp an instance of any of types."
+    if len(types) == 1:
+        types = types[0]
+    return GuardFunc._node('isoftype', types)
+
+@makeguard(cost=5)
+def isiterable(inp):
+    "Is inp iterable"
+    try:
+        iter(inp)
+    except TypeError:
+        return False
+    else:
+        return True
+
+@makeguard(cost=3)
+def eTrue(inp):
+    "Does inp evaluate to True."
+    return bool(inp)
+
+@makeguard(cost=3)
+def eFalse(inp):
+    "Does inp evaluate to False."
+    return not bool(inp)
+
+def In(val):
+    "Is inp in val"
+    _ in val # simple test for in support
+    return GuardFunc._node('In', val)
+def notIn(val):
+    "Is inp not in val"
+    _ in val # simple test for in support
+    return GuardFunc._node('notIn', val)
+
+def each(grd):
+    """
+    Is inp iterable, with each element passing grd. Containers are checked whole, NumPy arrays with `mask`.
+    Iterators (like generators, or files) pass, as checking them would consume them, but `guard` passes them on
+    wrapped in an iterator checking each element as it's consumed, which raises GuardError at the first wrong one.
+    So `guard` only takes it alone or joined with others by `&`, and raises ValueError if it's anywhere else.
+    """
+    if not isinstance(grd, GuardFunc):
+        raise TypeError("each() takes GuardFunc, not %s" % type(grd).__name__)
+    if _is_async(grd):
+        raise TypeError("Elements can't be checked with async guards")
+    return GuardFunc._node('each', grd)
+
+def _each_passes(grd, inp):
+    "Evaluates `each(grd)` on inp, see `each`."
+    try:
+        if iter(inp) is inp:
+            return True
+    except TypeError:
+        return False
+    if getattr(inp, 'ndim', None) == 1 and 'numpy' in sys.modules: # checked in bulk
+        return bool(grd.mask(inp).all())
+    test = grd.test
+    for item in inp:
+        if not test(item):
+            return False
+    return True
+
+def _element_guards(grd):
+    "Returns guards of `each` at the top of argument guard (alone or joined with &), which are checked on iterators."
+    if not isinstance(grd, GuardFunc):
+        return ()
+    grd = _simplify(grd)
+    return tuple(part.operands[0] for part in (grd.operands if grd.op == 'and' else (grd,)) if part.op == 'each')
+
+def _misplaced_each(grd, top=True):
+    """
+    Checks if guard has `each` anywhere else than at its top (alone or joined with &), e.g. under `|` or `~` or inside
+    a structural pattern, where iterators would pass it unchecked, see `_element_guards`.
+    """
+    if not isinstance(grd, GuardFunc):
+        return False
+    if grd.op == 'each':
+        return not top or _misplaced_each(grd.operands[0], False)
+    return any(_misplaced_each(operand, top and grd.op == 'and') for operand in grd.operands)
+
+def _lazily_checked(inp, test, name):
+    "Returns inp, or if it's an iterator, an iterator of its elements, which raises GuardError if test fails on one."
+    if iter(inp) is not inp:
+        return inp
+    return _checked_elements(inp, test, name)
+
+def _checked_elements(iterator, test, name):
+    "See `_lazily_checked`."
+    for i, item in enumerate(iterator):
+        if not test(item):
+            raise GuardError("Wrong value of element %i of argument '%s'" % (i, name))
+        yield item
+
+# STRUCTURAL PATTERNS #
+
+_sequence_types = (tuple, list) # matched by `seq`; strings are sequences too, but rarely meant to be destructured
+_accessors = ('item', 'attr', 'rest') # nodes checking a part of inp: (key, guard) operands
+
+def _pattern(val):
+    "Returns guard matching val: guards are taken as they are, `_` matches anything, other values are compared with."
+    if isinstance(val, GuardFunc):
+        return val
+    return GuardFunc._node('_') if val is _ else eq(val)
+
+def seq(*items, **kwargs):
+    """
+    Is inp a tuple or list of items matching given patterns (guards, or values to be equal to). With `rest`
+    pattern, inp may have more items, and the list or tuple of remaining ones has to match it, like Erlang's [H|T].
+    """
+    rest = kwargs.pop('rest', None)
+    if kwargs:
+        raise TypeError("seq() got unexpected keyword argument '%s'" % next(iter(kwargs)))
+    parts = [isoftype(_sequence_types), GuardFunc._node('length', len(items), rest is None)]
+    parts += [GuardFunc._node('item', i, _pattern(item)) for i, item in enumerate(items) if item is not _]
+    if rest is not None and rest is not _:
+        parts.append(GuardFunc._node('rest', len(items), _pattern(rest)))
+    return GuardFunc._node('and', *parts)
+
+def mapping(patterns=None, **kwargs):
+    """
+    Is inp a dict with given keys, whose values match patterns (guards, or values to be equal to). Keys are given as
+    a dict, or as keyword arguments if they're strings. Other keys may be there too.
+    """
+    patterns = dict(patterns or (), **kwargs)
+    return GuardFunc._node('and', isoftype(dict),
+                           *[GuardFunc._node('item', key, _pattern(val)) for key, val in patterns.items()])
+
+def attrs(_type=None, **patterns):
+    """
+    Is inp an instance of _type (if given), with attributes matching patterns (guards, or values to be equal to),
+    given as keyword arguments.
+    """
+    parts = [isoftype(_type)] if _type is not None else []
+    parts += [GuardFunc._node('attr', name, _pattern(val)) for name, val in sorted(patterns.items())]
+    return GuardFunc._node('and', *parts) if parts else GuardFunc._node('_')
+
+def bind(name, pattern=_):
+    """
+    Matches what pattern matches, and passes the matched value to guarded function as argument `name` (which has to
+    be one of its last parameters, not counted as the function's own arguments). Use inside `seq`, `mapping` and
+    `attrs` patterns, joined with others only by `&`.
+    """
+    if not _is_identifier(name):
+        raise ValueError("Captured value needs a valid parameter name, not %r" % (name,))
+    return GuardFunc._node('bind', name, _pattern(pattern))
+
+def _is_identifier(name):
+    "Checks if name can be put in generated source as a name of a variable or attribute."
+    if not isinstance(name, str) or keyword.iskeyword(name):
+        return False
+    if hasattr(name, 'isidentifier'):
+        return name.isidentifier()
+    return bool(name) and not name[0].isdigit() and all(char.isalnum() or char == '_' for char in name) # py2
+
+def _captures(grd, path=()):
+    """
+    Returns list of `(name, path)` of values captured by `bind` in guard tree, where path is a tuple of `(op, key)` of
+    accessor nodes leading from inp to the value. Captures under `|`, `^` and `~` raise ValueError, as values they
+    name might not be there.
+    """
+    if not isinstance(grd, GuardFunc):
+        return []
+    op = grd.op
+    if op == 'bind':
+        return [(grd.operands[0], path)] + _captures(grd.operands[1], path)
+    elif op in _accessors:
+        return _captures(grd.operands[1], path + ((op, grd.operands[0]),))
+    elif op == 'and':
+        return [capture for operand in grd.operands for capture in _captures(operand, path)]
+    elif op in ('or', 'xor', 'not') and any(_captures(operand) for operand in grd.operands):
+        raise ValueError("Values can't be captured under |, ^ or ~")
+    return []
+
+# GUARD COMPILER #
+
+_comparisons = {'eq': '==', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+_lower_bounds = {'gt': '<', 'ge': '<='} # gt(a) & lt(b) is folded to a < inp < b
+_upper_bounds = {'lt': '<', 'le': '<='}
+
+# types whose instances compare equal only if their hashes are equal, so lookups in hashed collections give the same
+# results as `==`.
+_hash_safe_types = frozenset((bool, float, complex, type(None), six.text_type, six.binary_type) + six.integer_types)
+
+_guard_costs = {'_': 0, 'Is': 1, 'Isnot': 1, 'eq': 2, 'ne': 2, 'lt': 2, 'le': 2, 'gt': 2, 'ge': 2, 'between': 3,
+                'isoftype': 3, 'In': 4, 'notIn': 4, 'length': 2}
+_each_cost = 50 # plus cost of guard for each element, with number of elements unknown
+_accessor_costs = {'item': 2, 'attr': 2, 'rest': 4} # plus cost of guard checking the part
+_default_test_cost = 10 # of custom guards and relguards without a cost hint
+_default_rejection_rate = 0.5
+
+def _cost(grd):
+    "Estimated cost of evaluating guard or relguard, where a comparison costs about 2."
+    if isinstance(grd, GuardFunc):
+        if grd.op in ('and', 'or', 'xor', 'not'):
+            return sum(_cost(operand) for operand in grd.operands)
+        if grd.op in _accessors:
+            return _accessor_costs[grd.op] + _cost(grd.operands[1])
+        if grd.op == 'each':
+            return _each_cost + _cost(grd.operands[0])
+        if grd.op == 'bind':
+            return _cost(grd.operands[1])
+        if grd.op in ('In', 'notIn'):
+            container = grd.operands[0]
+            if isinstance(container, list) or (isinstance(container, tuple)
+                                               and not all(type(val) in _hash_safe_types for val in container)):
+                return 2 + len(container) # scanned, not looked up
+        if grd.op != 'test':
+            return _guard_costs[grd.op]
+    return _default_test_cost if getattr(grd, 'cost', None) is None else grd.cost
+
+def _safe(grd):
+    "Checks if guard can't raise: if it's built only of guards shipped with fpm, which aren't custom tests."
+    if isinstance(grd, GuardFunc):
+        if grd.op in ('and', 'or', 'xor', 'not'):
+            return all(_safe(operand) for operand in grd.operands)
+        if grd.op in _accessors or grd.op == 'bind':
+            return _safe(grd.operands[1])
+        if grd.op == 'each':
+            return _safe(grd.operands[0])
+        return grd.op != 'test'
+    return grd is _
+
+def _by_cost(checks, cost, safe, rejection_rate=lambda check: _default_rejection_rate):
+    """
+    Orders checks joined with `and` (or `or`, for which `rejection_rate` is rate of passing), so that cheap and
+    selective ones go first: by cost divided by rejection rate, keeping given order on ties.
+
+    Checks which may raise (not `safe`) keep their order, and only safe ones can move ahead of them. So every check
+    which gets evaluated would be evaluated in given order too, and the outcome stays the same.
+    """
+    remaining = list(checks)
+    ordered = []
+    while remaining:
+        candidates = [i for i, check in enumerate(remaining) if i == 0 or safe(check)]
+        best = min(candidates, key=lambda i: (float(cost(remaining[i])) / max(rejection_rate(remaining[i]), 1e-3), i))
+        ordered.append(remaining.pop(best))
+    return ordered
+
+def _simplify(grd):
+    """
+    Returns simplified, but equivalent guard expression tree: nested `&` and `|` are flattened, `_` nodes dropped,
+    double negations removed, bounds on input are folded together (`between` node) and cheap operands of `&` and `|`
+    are moved ahead of expensive ones, where it can't change the outcome (see `_by_cost`).
+    """
+    op = grd.op
+    if op in ('and', 'or'):
+        children = []
+        for child in map(_simplify, grd.operands):
+            if child.op == op:
+                children.extend(child.operands)
+            else:
+                children.append(child)
+        if op == 'or' and any(child.op == '_' for child in children):
+            return GuardFunc._node('_')
+        children = [child for child in children if child.op != '_']
+        if op == 'and':
+            children = _drop_known_items(_fold_bounds(children))
+        children = _by_cost(children, _cost, _safe)
+        if not children:
+            return GuardFunc._node('_')
+        if len(children) == 1:
+            return children[0]
+        return GuardFunc._node(op, *children)
+    elif op == 'not':
+        child = _simplify(grd.operands[0])
+        return child.operands[0] if child.op == 'not' else GuardFunc._node('not', child)
+    elif op == 'xor':
+        return GuardFunc._node('xor', *map(_simplify, grd.operands))
+    elif op == 'bind': # only matters to `guard`, see `_captures`
+        return _simplify(grd.operands[1])
+    elif op in _accessors:
+        return GuardFunc._node(op, grd.operands[0], _simplify(grd.operands[1]))
+    elif op == 'each':
+        return GuardFunc._node('each', _simplify(grd.operands[0]))
+    else:
+        return grd
+
+def _fold_bounds(children):
+    "Replaces first lower and first upper bound among `&`-ed guards with a single `between` node."
+    lower = next((child for child in children if child.op in _lower_bounds), None)
+    upper = next((child for child in children if child.op in _upper_bounds), None)
+    if lower is None or upper is None:
+        return children
+    between = GuardFunc._node('between', lower, upper)
+    first = min(children.index(lower), children.index(upper))
+    folded = [child for child in children if child is not lower and child is not upper]
+    folded.insert(first, between)
+    return folded
+
+def _drop_known_items(children):
+    "Drops items of `&`-ed `seq` parts which only have to be there (e.g. to be captured), if length check implies it."
+    if not any(child.op == 'isoftype' and child.operands[0] is _sequence_types for child in children):
+        return children
+    length = max([child.operands[0] for child in children if child.op == 'length'] or [0])
+    return [child for child in children if not (child.op == 'item' and child.operands[1].op == '_'
+                                                and type(child.operands[0]) is int and 0 <= child.operands[0] < length)]
+
+def _guard_expression(src, grd, inp):
+    """
+    Returns source of a boolean expression evaluating `grd` on `inp`, or None if guard has to be evaluated with
+    statements, because the evaluation may raise TypeError.
+    """
+    op = grd.op
+    if op == '_':
+        return 'True'
+    elif op in ('Is', 'Isnot'):
+        return '(%s %s %s)' % (inp, 'is' if op == 'Is' else 'is not', src.inject('_fpm_value', grd.operands[0]))
+    elif op == 'isoftype':
+        try:
+            isinstance(None, grd.operands[0])
+        except TypeError: # not a type. Let it fail each time, like it would without compiling
+            return None
+        return '%s(%s, %s)' % (src.inject('_fpm_isinstance', isinstance), inp, src.inject('_fpm_types', grd.operands[0]))
+    elif op == 'each':
+        return '%s(%s, %s)' % (src.inject('_fpm_each_passes', _each_passes), src.inject('_fpm_guard', grd.operands[0]),
+                               inp)
+    elif op == 'not':
+        expr = _guard_expression(src, grd.operands[0], inp)
+        return None if expr is None else '(not %s)' % expr
+    elif op in ('and', 'or'):
+        exprs = [_guard_expression(src, child, inp) for child in grd.operands]
+        return None if None in exprs else '(%s)' % (' %s ' % op).join(exprs)
+    else:
+        return None
+
+def _raising_expression(src, grd, inp):
+    "Returns source of an expression evaluating leaf `grd` on `inp`, which may raise TypeError or not be boolean."
+    op = grd.op
+    if op == 'test':
+        if _iscoroutinefunction(grd.operands[0]):
+            return '(await %s(%s))' % (src.inject('_fpm_test', grd.operands[0]), inp)
+        return '%s(%s)' % (src.inject('_fpm_test', grd.operands[0]), inp)
+    elif op in _comparisons:
+        return '%s %s %s' % (inp, _comparisons[op], src.inject('_fpm_value', grd.operands[0]))
+    elif op == 'between':
+        lower, upper = grd.operands
+        return '%s %s %s %s %s' % (src.inject('_fpm_value', lower.operands[0]), _lower_bounds[lower.op], inp,
+                                   _upper_bounds[upper.op], src.inject('_fpm_value', upper.operands[0]))
+    elif op == 'isoftype':
+        return '%s(%s, %s)' % (src.inject('_fpm_isinstance', isinstance), inp, src.inject('_fpm_types', grd.operands[0]))
+    elif op == 'length':
+        length, exact = grd.operands
+        return '%s(%s) %s %i' % (src.inject('_fpm_len', len), inp, '==' if exact else '>=', length)
+    elif op in ('In', 'notIn'):
+        container = grd.operands[0]
+        contains = 'in' if op == 'In' else 'not in'
+        expr = '%s %s %s' % (inp, contains, src.inject('_fpm_container', container))
+        if isinstance(container, tuple) and all(type(val) in _hash_safe_types for val in container):
+            # hashed lookup gives the same result as scanning the container only if inp is of safe type, too. Only
+            # tuples can be copied to a frozenset, other containers may change after the guard is compiled.
+            expr = '(%s %s %s) if %s(%s) in %s else (%s)' % (
+                    inp, contains, src.inject('_fpm_container', frozenset(container)),
+                    src.inject('_fpm_type', type), inp, src.inject('_fpm_safe_types', _hash_safe_types), expr)
+        return expr
+    raise ValueError("Unknown guard operation '%s'" % op)
+
+def _guard_statements(src, grd, inp, target):
+    "Returns source lines which evaluate `grd` on `inp` and assign the boolean result to `target`."
+    expr = _guard_expression(src, grd, inp)
+    if expr is not None:
+        return ['%s = %s' % (target, expr)]
+
+    op = grd.op
+    if op in ('and', 'or'):
+        # consecutive operands that can't raise are evaluated in one expression, others one by one, nested in ifs
+        # checking result so far, so evaluation short-circuits.
+        groups = []
+        for child in grd.operands:
+            child_expr = _guard_expression(src, child, inp)
+            if child_expr is not None and groups and isinstance(groups[-1], list):
+                groups[-1].append(child_expr)
+            else:
+                groups.append([child_expr] if child_expr is not None else child)
+        lines, indent = [], ''
+        for i, group in enumerate(groups):
+            if i:
+                lines.append(indent + ('if %s:' if op == 'and' else 'if not %s:') % target)
+                indent += '    '
+            if isinstance(group, list):
+                group_lines = ['%s = %s' % (target, (' %s ' % op).join(group))]
+            else:
+                group_lines = _guard_statements(src, group, inp, target)
+            lines.extend(indent + line for line in group_lines)
+        return lines
+    elif op == 'not':
+        return _guard_statements(src, grd.operands[0], inp, target) + ['%s = not %s' % (target, target)]
+    elif op == 'xor':
+        left = src.name('_fpm_left')
+        return (_guard_statements(src, grd.operands[0], inp, left) +
+                _guard_statements(src, grd.operands[1], inp, target) +
+                ['%s = %s != %s' % (target, left, target)])
+    elif op in _accessors:
+        part = src.name('_fpm_part')
+        return [
+            'try:',
+            '    %s = %s' % (part, _access_expression(src, inp, ((op, grd.operands[0]),))),
+            'except %s:' % src.inject('_fpm_access_errors', (LookupError, TypeError, AttributeError)),
+            '    %s = False' % target,
+            'else:',
+        ] + ['    ' + line for line in _guard_statements(src, grd.operands[1], part, target)]
+    else:
+        return [
+            'try:',
+            '    %s = True if (%s) else False' % (target, _raising_expression(src, grd, inp)),
+            'except %s:' % src.inject('_fpm_TypeError', TypeError), # unorderable types compared, guard says no.
+            '    %s = False' % target,
+        ]
+
+def _access_expression(src, inp, path):
+    "Returns source of an expression getting the part of `inp` at `path` (see `_captures`)."
+    for op, key in path:
+        if op == 'item':
+            inp = '%s[%s]' % (inp, key if type(key) in six.integer_types else src.inject('_fpm_key', key))
+        elif op == 'attr':
+            if _is_identifier(key):
+                inp = '%s.%s' % (inp, key)
+            else: # set by setattr, like `attrs(**{'a-b': 1})`
+                inp = '%s(%s, %s)' % (src.inject('_fpm_getattr', getattr), inp, src.inject('_fpm_key', key))
+        else:
+            inp = '%s[%i:]' % (inp, key)
+    return inp
+
+_vector_comparisons = {'eq': operator.eq, 'ne': operator.ne, 'lt': operator.lt, 'le': operator.le, 'gt': operator.gt,
+                       'ge': operator.ge}
+_kind_types = {'b': bool, 'i': int, 'u': int, 'f': float, 'c': complex, 'U': six.text_type, 'S': six.binary_type}
+    # Python type of values in `tolist()` of NumPy array, by `dtype.kind`
+
+def _vector_comparable(kind, op, val):
+    "Checks if comparing array of given dtype kind with val gives the same results as comparing its elements."
+    if type(val) in six.integer_types + (bool, float):
+        return kind in 'biuf' or kind == 'c' and op in ('eq', 'ne')
+    elif type(val) is complex:
+        return kind in 'biufc' and op in ('eq', 'ne') # complex numbers are unorderable, NumPy orders them anyway
+    elif type(val) is six.text_type:
+        return kind == 'U'
+    elif type(val) is six.binary_type:
+        return kind == 'S'
+    return False
+
+def _as_array(numpy, values):
+    "Converts values to NumPy array. Iterables which aren't array-like give object arrays, holding values as they are."
+    if isinstance(values, numpy.ndarray) or hasattr(values, '__array__'):
+        return numpy.asarray(values)
+    return numpy.fromiter(values, dtype=object) # asarray could convert mixed values, e.g. [1, 'a'] to strings
+
+def _mask(numpy, grd, arr, items=False):
+    """
+    Returns array of booleans, results of simplified `grd` on each element of 1-d `arr`: on the element as NumPy
+    gives it (e.g. `numpy.int64`), or if `items` is True, on the Python value `arr.tolist()` holds for it (e.g. `int`).
+    """
+    op = grd.op
+    if op == '_':
+        return numpy.ones(len(arr), dtype=bool)
+    elif op in ('and', 'or'):
+        # like in compiled guard, operands are evaluated only on elements with result still undecided
+        undecided = None
+        for child in grd.operands:
+            passed = _mask(numpy, child, arr if undecided is None else arr[undecided], items)
+            rows = numpy.flatnonzero(passed if op == 'and' else ~passed)
+            undecided = rows if undecided is None else undecided[rows]
+            if not len(undecided):
+                break
+        result = numpy.zeros(len(arr), dtype=bool) if op == 'and' else numpy.ones(len(arr), dtype=bool)
+        result[undecided] = op == 'and'
+        return result
+    elif op == 'not':
+        return ~_mask(numpy, grd.operands[0], arr, items)
+    elif op == 'xor':
+        return _mask(numpy, grd.operands[0], arr, items) != _mask(numpy, grd.operands[1], arr, items)
+
+    result = _vector_mask(numpy, grd, arr, items)
+    if result is None: # element by element, with compiled guard
+        if not len(arr):
+            result = numpy.zeros(0, dtype=bool)
+        elif items: # frompyfunc passes Python values
+            result = numpy.frompyfunc(grd.test, 1, 1)(arr).astype(bool)
+        else:
+            result = numpy.fromiter(six.moves.map(grd.test, arr), dtype=bool, count=len(arr))
+    return result
+
+def _vector_mask(numpy, grd, arr, items=False):
+    """
+    Returns mask of leaf `grd` on `arr` evaluated with NumPy operations, or None if they'd give different results.
+    See `_mask` for `items`.
+    """
+    op, kind = grd.op, arr.dtype.kind
+    if op in _vector_comparisons or op == 'between':
+        bounds = grd.operands if op == 'between' else (grd,)
+        if not all(_vector_comparable(kind, bound.op, bound.operands[0]) for bound in bounds):
+            return None
+        try:
+            result = numpy.ones(len(arr), dtype=bool)
+            for bound in bounds:
+                passed = _vector_comparisons[bound.op](arr, bound.operands[0])
+                if not isinstance(passed, numpy.ndarray): # old NumPy gives up on elementwise comparison this way
+                    return None
+                result &= passed
+            return result
+        except (TypeError, OverflowError):
+            return None
+    elif op == 'isoftype':
+        if kind == 'O': # elements of object arrays have types of their own
+            return None
+        try:
+            element_type = _kind_types[kind] if items else arr.dtype.type
+            return numpy.full(len(arr), issubclass(element_type, grd.operands[0]), dtype=bool)
+        except (KeyError, TypeError): # no such Python type, or invalid types, which fail the same way for every element
+            return None
+    elif op in ('In', 'notIn'):
+        container = grd.operands[0]
+        if not (isinstance(container, (list, tuple, set, frozenset))
+                and all(_vector_comparable(kind, 'eq', val) for val in container)):
+            return None
+        result = numpy.isin(arr, list(container))
+        return result if op == 'In' else ~result
+    return None
+
+
+class RelGuard():
+    """
+    Class for relguard functions. It checks if test function is defined correctly, exposes its signature to the `guard`
+    decorator and passes only the needed arguments to test function when the guarded function is called.
+    """
+    cost = None # estimated cost of test, see `_cost`
+
+    def __init__(self, test, cost=None):
+        if not callable(test):
+            raise ValueError("Relguard test has to be callable")
+
+        # extract simplified signature
+        test_args = _getparams(test)
+
+        # varying args are not allowed, they make no sense in reguards.
+        _kinds = {x[1] for x in test_args}
+        if (p_kind.POSITIONAL_ONLY in _kinds or
+                p_kind.VAR_POSITIONAL in _kinds or
+                p_kind.VAR_KEYWORD in _kinds):
+            raise ValueError("Relguard test must take only named not varying arguments")
+
+        self.test = test
+        if cost is not None:
+            self.cost = cost
+        self.__argnames__ = {x[0] for x in test_args}
+        self._params = test_args # ordered, so `guard` can pass arguments to test positionally
+
+    def __reduce__(self):
+        "Pickled by name if made with `relguard` decorator (which shadows the test function), by test otherwise."
+        name = _global_name(self, self.test)
+        return (_load_global, name) if name is not None else (RelGuard, (self.test,))
+
+    _call = _compiled_on_access('_call')
+
+    def compile(self):
+        """
+        Compiles function which takes guarded function's arguments as keyword arguments, passes on the needed ones
+        (positionally, unless test takes them as keyword-only), and returns boolean. Missing arguments get test's own
+        defaults.
+        """
+        src = _Source({}, self.__argnames__)
+        rest = src.name('_fpm_rest')
+        positional = [name for name, kind in self._params if kind == p_kind.POSITIONAL_OR_KEYWORD]
+        kwonly = [name for name, kind in self._params if kind == p_kind.KEYWORD_ONLY]
+        arg_spec = _getfullargspec_p(self.test)
+        defaults = dict(zip(reversed(positional), reversed(arg_spec.defaults or ())))
+        defaults.update(getattr(arg_spec, 'kwonlydefaults', None) or {})
+        signature = [name if name not in defaults else '%s=%s' % (name, src.inject('_fpm_default', defaults[name]))
+                     for name in positional + kwonly]
+        if kwonly:
+            signature.insert(len(positional), '*')
+        signature.append('**' + rest)
+        is_async = _is_async(self)
+        return src.compile('relguard', ', '.join(signature), [
+            'try:',
+            '    return bool(%s%s(%s))' % ('await ' if is_async else '', src.inject('_fpm_test', self.test),
+                                         ', '.join(positional + ['%s=%s' % (name, name) for name in kwonly])),
+            # occures when unorderable types are compared, but we don't want TypeError to be raised.
+            'except %s:' % src.inject('_fpm_TypeError', TypeError),
+            '    return False',
+        ], '<relguard>', is_async=is_async)
+
+    def __call__(self, **kwargs):
+        try:
+            return self._call(**kwargs)
+        except TypeError: # some of test's arguments are missing
+            return False
+
+def relguard(decoratee):
+    "Decorator which turns decoratee to RelGuard object."
+    return RelGuard(decoratee)
+
+
+def _compile_guarded(decoratee, arg_spec, argument_guards, rel_guard, namespace, mode='on', sampling=None,
+                     rejection_rates=None, tuning=None, captures=None, hooked=None):
+    """
+    Generates a wrapper specialised for decoratee's signature and guards, compiles it in `namespace` and returns it.
+
+    The wrapper takes exactly the same parameters as decoratee, checks guards inline on its locals and passes them
+    on positionally, so a call that gets through all guards allocates nothing on its own.
+
+    `mode` is one of:
+    - 'on': guards are checked on every call, GuardError is raised if any of them fails.
+    - 'match': generated function just returns whether arguments pass guards, instead of raising GuardError or calling
+      decoratee.
+    - 'check': like 'on', but decoratee is not called.
+    - 'off': decoratee is called straight away.
+    - 'sample': `sampling` is `(every, report, wrapper)`; guards are checked once in `every` calls and GuardError is
+      passed to `report(wrapper, error)` instead of being raised.
+    - 'body': like 'off', but iterators are checked lazily (see below). Called by MultiFunc once clause matched.
+
+    In 'on' and 'body' modes, arguments which are iterators and have guards made with `each` are passed on wrapped
+    in iterators checking each element as decoratee consumes it.
+
+    Wrapper is a coroutine function if decoratee is one (then it awaits decoratee), or if any guard has to be awaited,
+    whichever the mode is, so switching modes never changes how the wrapper is called.
+
+    Guards are checked in order given by `_by_cost`, using `rejection_rates` (check key -> rate, where key is argument
+    name, or None for relguard) if known. With `tuning` (a `_GuardTuning`), wrapper counts evaluations and rejections
+    of each check.
+
+    `captures` maps names of decoratee's parameters left out of `arg_spec` to `(argument name, path)` of values
+    captured for them by `bind` (see `_argument_captures`), which are passed to decoratee as keyword arguments.
+    Values are only there once guards passed, so 'off' and 'sample' modes are 'on' for wrappers with captures.
+
+    `hooked` is the function given to 'guard_rejected' and 'relguard_rejected' hooks (see `add_hook`). Their calls are
+    only generated for events that have callbacks when wrapper is compiled.
+    """
+    kwonlyargs = tuple(getattr(arg_spec, 'kwonlyargs', ())) # py2, no kwonlyargs
+    kwonlydefaults = getattr(arg_spec, 'kwonlydefaults', None) or {}
+    varkw = getattr(arg_spec, 'varkw', None) or arg_spec.keywords
+    defaults = arg_spec.defaults or ()
+    first_default = len(arg_spec.args) - len(defaults)
+    posonlycount = getattr(arg_spec, 'posonlycount', 0) # inspect's specs (py<3.3) have none
+    filename = '<guarded %s>' % getattr(decoratee, '__name__', type(decoratee).__name__) # partials have no name
+
+    if captures and mode in ('off', 'sample'):
+        mode = 'on' # captured values are only there once guards passed, so they're checked on every call
+    guards_async = _is_async(rel_guard) or any(_is_async(grd) for grd in argument_guards.values())
+    decoratee_async = mode not in ('match', 'check') and _iscoroutinefunction(decoratee)
+    matcher = mode == 'match'
+
+    src = _Source(namespace, set(arg_spec.args) | set(kwonlyargs) | {arg_spec.varargs, varkw})
+    fun_name = src.name('matches' if matcher else 'guarded')
+
+    def passed(arg):
+        "Returns source of the value of argument passed to decoratee."
+        elements = _element_guards(argument_guards.get(arg, _)) if mode in ('on', 'body') else ()
+        if not elements:
+            return arg
+        check = elements[0] if len(elements) == 1 else GuardFunc._node('and', *elements)
+        return '%s(%s, %s, %r)' % (src.inject('_fpm_lazily_checked', _lazily_checked), arg,
+                                   src.inject('_fpm_element_test', check.test), arg)
+
+    signature, call = [], []
+    for i, arg in enumerate(arg_spec.args):
+        if i >= first_default:
+            signature.append('%s=%s' % (arg, src.inject('_fpm_default', defaults[i - first_default])))
+        else:
+            signature.append(arg)
+        if i + 1 == posonlycount:
+            signature.append('/')
+        call.append(passed(arg))
+    if arg_spec.varargs:
+        signature.append('*' + arg_spec.varargs)
+        call.append('*' + arg_spec.varargs)
+    elif kwonlyargs:
+        signature.append('*')
+    for arg in kwonlyargs:
+        if arg in kwonlydefaults:
+            signature.append('%s=%s' % (arg, src.inject('_fpm_default', kwonlydefaults[arg])))
+        else:
+            signature.append(arg)
+        call.append('%s=%s' % (arg, passed(arg)))
+    check_call = list(call) # arguments of the function itself, without captured values
+    for name, (arg_name, path) in (captures or {}).items():
+        call.append('%s=%s' % (name, _access_expression(src, arg_name, path)))
+    if varkw:
+        signature.append('**' + varkw)
+        call.append('**' + varkw)
+        check_call.append('**' + varkw)
+
+    def reject(message, arg_name=None):
+        "Returns statement rejecting call, by failed guard of `arg_name` or by relguard if None."
+        statement = 'return False' if matcher else 'raise %s(%r)' % (src.inject('_fpm_GuardError', GuardError), message)
+        event = 'relguard_rejected' if arg_name is None else 'guard_rejected'
+        if hooked is None or event not in _hooks:
+            return statement
+        if arg_name is None:
+            hook_args = '{%s}' % ', '.join('%r: %s' % (name, name) for name in tuple(arg_spec.args) + kwonlyargs)
+        else:
+            hook_args = '%r, %s' % (arg_name, arg_name)
+        return '%s(%r, %s, %s); %s' % (src.inject('_fpm_emit', _emit), event, src.inject('_fpm_hooked', hooked),
+                                       hook_args, statement)
+
+    body = []
+    if mode in ('off', 'body'):
+        return src.compile(fun_name, ', '.join(signature), [
+            'return %s%s(%s)' % ('await ' if decoratee_async else '', src.inject('_fpm_decoratee', decoratee),
+                                 ', '.join(call)),
+        ], filename, is_async=(guards_async and mode == 'off') or decoratee_async)
+    if mode == 'sample':
+        every, report, wrapper = sampling
+        check = _compile_guarded(decoratee, arg_spec, argument_guards, rel_guard, {}, mode='check',
+                                 rejection_rates=rejection_rates, hooked=hooked)
+        error = src.name('_fpm_error')
+        return src.compile(fun_name, ', '.join(signature), [
+            'if %s(%s):' % (src.inject('_fpm_next', next),
+                            src.inject('_fpm_sample', itertools.cycle((True,) + (False,) * (every - 1)))),
+            '    try:',
+            '        %s%s(%s)' % ('await ' if guards_async else '', src.inject('_fpm_check', check),
+                                  ', '.join(check_call)),
+            '    except %s as %s:' % (src.inject('_fpm_GuardError', GuardError), error),
+            '        %s(%s, %s)' % (src.inject('_fpm_report', report), src.inject('_fpm_wrapper', wrapper), error),
+            'return %s%s(%s)' % ('await ' if decoratee_async else '', src.inject('_fpm_decoratee', decoratee),
+                                 ', '.join(call)),
+        ], filename, is_async=guards_async or decoratee_async)
+
+    # each check is (key, guard, lines rejecting the call if guard fails), relguard (key None) comes first.
+    checks = []
+    if isinstance(rel_guard, RelGuard):
+        rejected = src.name('_fpm_rejected')
+        rel_args = ', '.join(name if kind == p_kind.POSITIONAL_OR_KEYWORD else '%s=%s' % (name, name)
+                             for name, kind in rel_guard._params)
+        checks.append((None, rel_guard, [
+            'try:',
+            '    %s = not %s%s(%s)' % (rejected, 'await ' if _is_async(rel_guard) else '',
+                                     src.inject('_fpm_relguard', rel_guard.test), rel_args),
+            'except %s:' % src.inject('_fpm_TypeError', TypeError), # unorderable types compared, relguard says no.
+            '    %s = True' % rejected,
+            'if %s:' % rejected,
+            '    ' + reject("Arguments did not pass through relguard"),
+        ]))
+    elif rel_guard is not _: # any callable, allowed with strict_guard_definitions off
+        rel_args = ['%s=%s' % (name, name) for name in tuple(arg_spec.args) + kwonlyargs]
+        if varkw:
+            rel_args.append('**' + varkw)
+        checks.append((None, rel_guard, [
+            'if not %s%s(%s):' % ('await ' if _is_async(rel_guard) else '', src.inject('_fpm_relguard', rel_guard),
+                                  ', '.join(rel_args)),
+            '    ' + reject("Arguments did not pass through relguard"),
+        ]))
+
+    # check arguments one by one, GuardFunc expressions are inlined.
+    for arg_name, grd in argument_guards.items():
+        if grd is _:
+            continue
+        lines = []
+        if isinstance(grd, GuardFunc):
+            grd = _simplify(grd)
+            expr = _guard_expression(src, grd, arg_name)
+            if expr is None:
+                expr = src.name('_fpm_passed')
+                lines += _guard_statements(src, grd, arg_name, expr)
+        else:
+            expr = '%s%s(%s)' % ('await ' if _is_async(grd) else '', src.inject('_fpm_guard', grd), arg_name)
+        lines += [
+            'if not %s:' % expr,
+            '    ' + reject("Wrong value for keyword argument '%s'" % arg_name, arg_name),
+        ]
+        checks.append((arg_name, grd, lines))
+
+    rates = rejection_rates or {}
+    checks = _by_cost(checks, lambda check: _cost(check[1]), lambda check: _safe(check[1]),
+                      lambda check: rates.get(check[0], _default_rejection_rate))
+    if tuning is not None: # count how often each check is evaluated and how often it rejects
+        tuning_name = src.inject('_fpm_tuning', tuning)
+        body += [
+            '%s.calls -= 1' % tuning_name,
+            'if %s.calls == 0:' % tuning_name,
+            '    %s.done()' % tuning_name,
+        ]
+        for key, grd, lines in checks:
+            counts = src.inject('_fpm_counts', tuning.counts[key])
+            body.append('%s[0] += 1' % counts)
+            body += lines[:-1] + [lines[-1][:4] + '%s[1] += 1' % counts, lines[-1]]
+    else:
+        for key, grd, lines in checks:
+            body += lines
+
+    if matcher:
+        body.append('return True')
+    elif mode == 'check':
+        body.append('return None')
+    else:
+        body.append('return %s%s(%s)' % ('await ' if decoratee_async else '', src.inject('_fpm_decoratee', decoratee),
+                                         ', '.join(call)))
+
+    return src.compile(fun_name, ', '.join(signature), body, filename,
+                       is_async=guards_async or decoratee_async)
+
+_first_call_code = _Source({}).compile('first_call', '*args, **kwargs', ['return _fpm_first_call(*args, **kwargs)'],
+                                      '<first call>').__code__
+
+def _compiled_on_first_call(name, build):
+    """
+    Returns function which is compiled on its first call: `build(namespace)` compiles the actual function in
+    `namespace` (the returned function's globals), whose code and defaults are taken over before the call goes on.
+    """
+    namespace = {'__builtins__': six.moves.builtins}
+    fun = types.FunctionType(_first_call_code, namespace, name)
+
+    def first_call(*args, **kwargs):
+        _compile_now(fun)
+        return fun(*args, **kwargs)
+
+    namespace['_fpm_first_call'] = first_call
+    namespace['_fpm_build'] = build
+    return fun
+
+def _compile_now(fun):
+    "Compiles function returned by `_compiled_on_first_call`, if it hasn't been compiled yet."
+    if fun.__code__ is _first_call_code:
+        compiled = fun.__globals__['_fpm_build'](fun.__globals__)
+        fun.__defaults__ = compiled.__defaults__
+        if hasattr(compiled, '__kwdefaults__'): # py2
+            fun.__kwdefaults__ = compiled.__kwdefaults__
+        fun.__code__ = compiled.__code__
+
+def _validate(guarded):
+    "Checks guard definitions of guarded function, if it was deferred (see `defer_validation`)."
+    validate = guarded._validate
+    if validate is not None:
+        validate()
+        guarded._validate = None
+
+def finalize():
+    """
+    Checks guard definitions of all guarded functions, which were deferred because `defer_validation` was set.
+    Raises ValueError on the first wrong definition.
+    """
+    for guarded in list(_guarded_functions):
+        _validate(guarded)
+
+class _ArgumentGuards(OrderedDict):
+    """
+    Argument name -> guard mapping of a guarded function. Recompiles the function whenever a guard is changed, which
+    is what `case` does when extending guards of an already guarded clause.
+    """
+    _on_change = None
+
+    def __setitem__(self, key, value):
+        _check_each(key, value)
+        OrderedDict.__setitem__(self, key, value)
+        if self._on_change is not None:
+            self._on_change()
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        if self._on_change is not None:
+            self._on_change()
+
+def _check_each(arg_name, grd):
+    "Raises ValueError if argument's guard has `each` where iterators would pass it unchecked."
+    if _misplaced_each(grd):
+        raise ValueError("each() in guard of argument '%s' has to be alone or joined with others by &, elsewhere "
+                         "iterators would pass it unchecked" % arg_name)
+
+def _argument_captures(decoratee, arg_spec, argument_guards):
+    """
+    Returns OrderedDict: name of decoratee's parameter -> `(argument name, path)` of value captured for it by `bind`
+    in argument guards (see `_captures`), in order of parameters. Raises ValueError unless they're decoratee's last
+    positional parameters, without guards of their own.
+    """
+    found = OrderedDict()
+    for arg_name, grd in argument_guards.items():
+        for name, path in _captures(grd):
+            if name in found:
+                raise ValueError("Value for '%s' captured more than once" % name)
+            found[name] = (arg_name, path)
+    if not found:
+        return found
+
+    names = arg_spec.args[len(arg_spec.args) - len(found):]
+    if set(names) != set(found) or arg_spec.varargs:
+        raise ValueError("Parameters for captured values (%s) have to be the last ones of %s(), and it can't take "
+                         "*args" % (', '.join(found), decoratee.__name__))
+    for name in names:
+        if argument_guards.get(name, _) is not _:
+            raise ValueError("Value of '%s' is captured, it can't have a guard" % name)
+    return OrderedDict((name, found[name]) for name in names)
+
+def _without_captured(arg_spec, captures):
+    "Returns arg_spec without parameters for captured values, which are the last ones."
+    defaults = arg_spec.defaults
+    if defaults:
+        defaults = defaults[:max(len(defaults) - len(captures), 0)] or None
+    args = arg_spec.args[:len(arg_spec.args) - len(captures)]
+    return _ArgSpec(args, arg_spec.varargs, getattr(arg_spec, 'kwonlyargs', []), arg_spec.keywords, defaults,
+                    getattr(arg_spec, 'kwonlydefaults', None), getattr(arg_spec, 'annotations', {}),
+                    min(getattr(arg_spec, 'posonlycount', 0), len(args)))
+
+def guard(*dargs, **dkwargs):
+    "Checks if arguments meet criteria when the function is called."
+
+    def decorator(decoratee):
+        "Actual decorator."
+
+        # guard nesting is not allowed
+        if hasattr(decoratee, '__guarded__'):
+            raise ValueError("%s() has guards already set" % decoratee.__name__)
+        # get arg_spec
+        arg_spec = _getfullargspec_p(decoratee)
+
+        # parse dargs'n'dkwargs
+        try:
+            arg_list = arg_spec.args + arg_spec.kwonlyargs
+        except AttributeError: # py2, no kwonlyargs
+            arg_list = arg_spec.args
+
+        # check if number of guards makes sense
+        if len(dargs) > len(arg_spec.args) or len(dkwargs) > len(arg_list):
+            raise ValueError("Too many guard definitions for '%s()'" % decoratee.__name__)
+
+        if len(dargs) == 1 and isinstance(dargs[0], RelGuard): # check if relguard is specified
+            rel_guard = dargs[0]
+            argument_guards = OrderedDict((arg, _) for arg in arg_spec.args) # might raise IndexError if empty
+            _already_bound = () # UnboundLocalError emerges if this is not defined.
+        elif len(dargs) == 1 and isinstance(dargs[0], types.FunctionType): # decorate directly (guards in annotations)
+            rel_guard = _
+            argument_guards = OrderedDict((arg, _) for arg in arg_spec.args) # might raise IndexError if empty
+            _already_bound = () # UnboundLocalError emerges if this is not defined.
+        else:
+            rel_guard = _
+            # bind positionals to their names
+            argument_guards = OrderedDict(six.moves.zip_longest(arg_spec.args, dargs, fillvalue=_))
+            _already_bound = arg_spec.args[:len(dargs)] # names of arguments matched with dargs
+
+        for arg_name in dkwargs.keys():
+            if arg_name in _already_bound: # check if guards in kwargs does not overlap with those bound above
+                raise ValueError("Multiple definitions of guard for argument '%s'" % arg_name)
+            if arg_name not in arg_list: # check if arg names are valid
+                raise ValueError("Unexpected guard definition for not recognised argument '%s'" % arg_name)
+        # no overlaps, so extend argument_guards:
+        argument_guards.update(dkwargs)
+
+        # if argument_guards is empty (catch-all, more precisely), try extracting guards from annotations
+        if all(grd is _ for grd in argument_guards.values()):
+            try:
+                arg_annotations = arg_spec.annotations # raises AttributeError in py2
+                six.next(six.iterkeys(arg_annotations))
+            except (AttributeError, # arg_spec was produced by getargspec (py2) thus we need to parse dargs'n'dkwargs
+                    StopIteration): # or annotations are empty (py3)
+                pass
+            else:
+                argument_guards = OrderedDict(
+                        (arg_name, arg_annotations.get(arg_name, _)) # name -> annotation, or _ if no annotation.
+                        for arg_name in arg_list # arg_list dictates right order
+                        )
+        if rel_guard is _:
+            try:
+                rel_guard = arg_spec.annotations.get("return", _)
+            except AttributeError:
+                pass
+
+        if (not argument_guards or all(grd is _ for grd in argument_guards.values())) and rel_guard is _:
+            raise ValueError("No guards specified for '%s()'" % decoratee.__name__)
+
+        for arg_name, grd in argument_guards.items():
+            _check_each(arg_name, grd)
+
+        # parameters for values captured by patterns are filled in by guarded, which doesn't take them
+        captures = _argument_captures(decoratee, arg_spec, argument_guards)
+        if captures:
+            arg_spec = _without_captured(arg_spec, captures)
+            arg_list = [arg for arg in arg_list if arg not in captures]
+            argument_guards = OrderedDict((arg, grd) for arg, grd in argument_guards.items() if arg not in captures)
+
+        strict = strict_guard_definitions
+
+        def validate():
+            "Checks if guards are really guards, or at least callable, and if relguard's arguments fit decoratee."
+            if rel_guard is not _ and not isinstance(rel_guard, RelGuard):
+                if strict:
+                    raise ValueError("Specified relguard must be an instance of RelGuard, not %s" % type(rel_guard).__name__)
+                else:
+                    if not callable(rel_guard):
+                        raise ValueError("Specified relguard is not callable")
+                    warnings.warn("Specified relguard is not an instance of RelGuard. Its behaviour may be unexpected.",
+                            RuntimeWarning)
+
+            for arg_name, grd in argument_guards.items():
+                if grd is not _ and not isinstance(grd, GuardFunc):
+                    if strict:
+                        raise ValueError("Guard specified for argument '%s' must be an instance of GuardFunc, not %s"
+                                % (arg_name, type(grd).__name__))
+                    else:
+                        if not callable(grd):
+                            raise ValueError("Guard specified for argument '%s' is not callable" % arg_name)
+                        warnings.warn("Guard specified for argument '%s' is not an instance of GuardFunc. Its behaviour may be unexpected."
+                                % arg_name, RuntimeWarning)
+
+            # check if relguard argument names fits with decoratee
+            if isinstance(rel_guard, RelGuard): # only RelGuard objects have __argnames__ attr.
+                for arg in rel_guard.__argnames__:
+                    if arg not in arg_list:
+                        raise ValueError("Relguard's argument names must be a subset of %s argument names" % decoratee.__name__)
+
+        if not defer_validation:
+            validate()
+        argument_guards = _ArgumentGuards(argument_guards)
+
+        def compile_wrapper(namespace):
+            "Compiles guarded, checking current argument guards in its effective guard mode."
+            _validate(guarded)
+            mode, every, report = guarded._guard_mode or _guard_mode
+            return _compile_guarded(decoratee, arg_spec, argument_guards, rel_guard, namespace,
+                                    mode, (every, report, guarded), guarded._rejection_rates, guarded._tuning,
+                                    captures, guarded)
+
+        def compile_matcher(namespace):
+            "Compiles matches, checking current argument guards."
+            _validate(guarded)
+            return _compile_guarded(decoratee, arg_spec, argument_guards, rel_guard, namespace, mode='match',
+                                    rejection_rates=guarded._rejection_rates, tuning=guarded._tuning,
+                                    hooked=guarded)
+
+        # both are compiled on first call, most clauses of `case` never have their guarded wrapper called.
+        guarded = six.wraps(decoratee)(_compiled_on_first_call('guarded', compile_wrapper))
+        matches = _compiled_on_first_call('matches', compile_matcher)
+        matches._wrapper = guarded # MultiFunc calls decoratee directly only if nothing else wraps guarded
+
+        def make_body():
+            """
+            Returns function for MultiFunc to call instead of decoratee once clause matches, if decoratee needs
+            captured values, or iterators whose elements are checked lazily. Returns None otherwise.
+            """
+            if not captures and not any(_element_guards(grd) for grd in argument_guards.values()):
+                return None
+            body = _compiled_on_first_call('body', lambda namespace: _compile_guarded(
+                    decoratee, arg_spec, argument_guards, rel_guard, namespace, mode='body', captures=captures))
+            if _iscoroutinefunction(decoratee):
+                _compile_now(body)
+            return body
+
+        def recompile_wrapper():
+            "Swaps code of guarded for one checking current argument guards in its effective guard mode."
+            if guarded.__code__ is not _first_call_code:
+                guarded.__code__ = compile_wrapper(guarded.__globals__).__code__
+
+        def recompile():
+            "Swaps code of guarded and matches for one checking current argument guards. Called when they change."
+            recompile_wrapper()
+            if matches.__code__ is not _first_call_code:
+                matches.__code__ = compile_matcher(matches.__globals__).__code__
+            guarded._body = make_body()
+
+        argument_guards._on_change = recompile
+
+        guarded._matches = matches # checks guards without raising GuardError, unaffected by guard mode
+        guarded._argument_guards = argument_guards
+        guarded._relguard = rel_guard
+        guarded._guard_mode = None # follow global guard mode
+        guarded._recompile = recompile_wrapper
+        guarded._recompile_checks = recompile
+        guarded._rejection_rates = None # observed by `tune_guards`
+        guarded._tuning = None
+        guarded._validate = validate if defer_validation else None
+        guarded._captures = tuple(captures)
+        guarded._body = make_body()
+        guarded.__guarded__ = decoratee
+        with _guard_mode_lock:
+            _guarded_functions.add(guarded)
+        if (_iscoroutinefunction(decoratee) or _is_async(rel_guard)
+                or any(_is_async(grd) for grd in argument_guards.values())):
+            _compile_now(guarded) # coroutine functions have to be told apart before they're called
+            _compile_now(matches)
+        return guarded
+
+    # decide whether initialise decorator
+    if len(dkwargs) == 0 and len(dargs) == 1 and callable(dargs[0]) and not isinstance(dargs[0], (GuardFunc, RelGuard)):
+        return decorator(dargs[0])
+    else:
+        return decorator
+
+class _GuardTuning(object):
+    "Counts evaluations and rejections of checks of a guarded function, see `tune_guards`."
+    def __init__(self, calls, done):
+        self.calls = calls
+        self.counts = defaultdict(lambda: [0, 0]) # check key -> [evaluated, rejected]
+        self.done = done
+
+def tune_guards(func, calls=1000):
+    """
+    Counts how often each guard (and relguard) of guarded function rejects a call, during its next `calls` calls or
+    dispatches to it, and then checks them in order given by both their costs and observed rejection rates. For a
+    MultiFunc, tunes guards of all its guarded clauses.
+    """
+    if isinstance(func, MultiFunc):
+        for clauses in func.clauses.values():
+            for clause in clauses:
+                if hasattr(clause, '_recompile_checks'):
+                    tune_guards(clause, calls)
+        return
+    if not hasattr(func, '_recompile_checks'):
+        raise ValueError("%s() is not guarded" % getattr(func, '__name__', func))
+    if calls < 1:
+        raise ValueError("Guards have to be tuned for at least one call")
+
+    def done():
+        "Stops counting and recompiles function with checks ordered by observed rejection rates."
+        if func._tuning is not tuning:
+            return
+        func._rejection_rates = dict((key, float(rejected) / evaluated)
+                                     for key, (evaluated, rejected) in tuning.counts.items() if evaluated)
+        func._tuning = None
+        func._recompile_checks()
+
+    tuning = func._tuning = _GuardTuning(calls, done)
+    func._recompile_checks() # if compiled already
+    _compile_now(func)
+    _compile_now(func._matches)
+
+def rguard(rel_guard, **kwargs):
+    """
+    Converts first and only positional argument to a RelGuard object.
+    By using rguard you guarantee that `rel_guard` is a correctly defined relguard function.
+    """
+    return guard(RelGuard(rel_guard), **kwargs)
+
+def raguard(decoratee):
+    """
+    Converts return annotation to a RelGuard object.
+    By using raguard you guarantee that return annotation holds a correctly defined relguard function.
+    """
+    try:
+        rel_guard = decoratee.__annotations__['return']
+    except (AttributeError, KeyError):
+        raise ValueError("raguard requires return annotation")
+    else:
+        return guard(RelGuard(rel_guard))(decoratee)
+
+def _report_guard_error(func, error):
+    "Default `report` callback of sampled guard checks, warns instead of raising."
+    warnings.warn("%s(): %s" % (func.__name__, error), RuntimeWarning, stacklevel=3)
+
+def set_guard_mode(mode, every=100, report=None, func=None):
+    """
+    Switches how guarded functions check their guards:
+    - 'on': on every call, raising GuardError (the default),
+    - 'sample': once in `every` calls, passing GuardError to `report(func, error)` instead of raising it (by default
+      a RuntimeWarning is issued),
+    - 'off': never, the decoratee is called straight away.
+
+    Sets global mode, or only `func`'s if given. `mode=None` makes `func` follow global mode again. Guards of `case`
+    clauses decide dispatch, and guards of functions capturing values with `bind` find the values, so they are always
+    checked.
+    """
+    if mode not in ('on', 'sample', 'off') and (mode is not None or func is None):
+        raise ValueError("Unknown guard mode %r" % (mode,))
+    if mode == 'sample' and every < 1:
+        raise ValueError("Guards must be checked at least once in `every` calls")
+    setting = None if mode is None else (mode, every, report or _report_guard_error)
+    global _guard_mode
+    with _guard_mode_lock:
+        if func is not None:
+            if not hasattr(func, '_recompile'):
+                raise ValueError("%s() is not guarded" % getattr(func, '__name__', func))
+            func._guard_mode = setting
+            func._recompile()
+        else:
+            _guard_mode = setting
+            for guarded in list(_guarded_functions):
+                if guarded._guard_mode is None:
+                    guarded._recompile()
+
+# HOOKS #
+
+_guard_events = ('guard_rejected', 'relguard_rejected')
+_dispatch_events = ('clause_selected', 'match_miss', 'clause_start', 'clause_end')
+_hooks = {} # event -> tuple of callbacks, replaced (never changed) by `add_hook` and `remove_hook`
+_multi_funcs = weakref.WeakSet() # their selectors are dropped when the set of hooked events changes
+
+def add_hook(event, callback):
+    """
+    Registers callback called on given event, with arguments:
+    - 'clause_selected': `(func, clause, args, kwargs)`, when MultiFunc `func` chose clause for a call,
+    - 'match_miss': `(func, args, kwargs)`, when no clause of `func` matched a call,
+    - 'clause_start': `(func, clause, args, kwargs)`, right before the chosen clause runs,
+    - 'clause_end': `(func, clause, duration, error)`, after it returned (error is None) or raised error, duration is
+      in seconds,
+    - 'guard_rejected': `(guarded, arg_name, value)`, when guard of guarded function's argument rejected a call (or
+      a clause's match),
+    - 'relguard_rejected': `(guarded, arguments)`, when its relguard did, `arguments` is a dict of named arguments.
+
+    Calls of callbacks are compiled into guarded functions and dispatch only while the event has any, so unhooked
+    events cost nothing. Registering the first callback of an event (or removing the last one) recompiles all guarded
+    functions, or rebuilds dispatch of all MultiFuncs. Async clauses and clauses compiled into a decision tree (see
+    `MultiFunc.compile`) aren't hooked, decision tree isn't used while guards are. Returns callback.
+    """
+    if event not in _guard_events + _dispatch_events:
+        raise ValueError("Unknown hook event %r" % (event,))
+    if not callable(callback):
+        raise ValueError("Hook callback is not callable")
+    with _guard_mode_lock:
+        hooks = dict(_hooks)
+        hooks[event] = hooks.get(event, ()) + (callback,)
+        _set_hooks(hooks)
+    return callback
+
+def remove_hook(event, callback):
+    "Unregisters callback registered by `add_hook`."
+    with _guard_mode_lock:
+        callbacks = list(_hooks.get(event, ()))
+        if callback not in callbacks:
+            raise ValueError("%r is not a hook of %r event" % (callback, event))
+        callbacks.remove(callback)
+        hooks = dict(_hooks)
+        hooks[event] = tuple(callbacks)
+        if not callbacks:
+            del hooks[event]
+        _set_hooks(hooks)
+
+def _set_hooks(hooks):
+    """
+    Replaces hook registry, recompiling guarded functions and dropping selectors of MultiFuncs if it changes which
+    of their events are hooked. Called with `_guard_mode_lock` held.
+    """
+    global _hooks
+    changed = set(hooks).symmetric_difference(_hooks)
+    _hooks = hooks
+    if changed.intersection(_guard_events):
+        for guarded in list(_guarded_functions):
+            guarded._recompile_checks()
+    if changed:
+        for func in list(_multi_funcs):
+            with func._lock:
+                func._selectors = {}
+
+def _emit(event, *args):
+    "Calls callbacks of event with args."
+    for callback in _hooks.get(event, ()):
+        callback(*args)
+
+def _hooked(events):
+    "Checks if any of events has callbacks."
+    return any(event in _hooks for event in events)
+
+class FileExporter(object):
+    """
+    Hooks (see `add_hook`) writing what happens in dispatch to a file at `path`, to be correlated with request traces
+    and such. `install()` registers them, `uninstall()` removes them and closes the file.
+
+    By default, every `every`th run of a clause (as a span: 'start' time and 'duration'), miss and guard rejection is
+    appended to the file as a JSON object on its own line (JSON Lines) with 'event', 'function', 'line' of clause,
+    'time' (seconds since the epoch) and 'thread'. If `context` is given, what it returns (e.g. current trace id)
+    is added as 'context'. Argument values are never written.
+
+    With `histograms=True`, durations of clause runs are counted in `buckets` (upper bounds in seconds) for each
+    clause, and so are misses for each function. `flush()` (and `uninstall()`) writes them in Prometheus text format,
+    replacing the file.
+    """
+    def __init__(self, path, every=1, histograms=False, buckets=(1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0),
+                 context=None):
+        if every < 1:
+            raise ValueError("Events must be written at least once in `every` events")
+        self.path = path
+        self.histograms = histograms
+        self.buckets = tuple(sorted(buckets))
+        self.context = context
+        self._sample = itertools.cycle((True,) + (False,) * (every - 1))
+        self._lock = threading.Lock()
+        self._file = None
+        self._durations = {} # (function name, line) -> [count in each bucket and above them, sum]
+        self._misses = defaultdict(int) # function name -> misses
+        if histograms:
+            self._callbacks = {'clause_end': self._count_duration, 'match_miss': self._count_miss}
+        else:
+            self._callbacks = {'clause_end': self._span, 'match_miss': self._miss,
+                           'guard_rejected': self._guard_rejected, 'relguard_rejected': self._relguard_rejected}
+
+    def install(self):
+        "Registers hooks, opens the file for events. Returns self."
+        if not self.histograms:
+            import json # only needed for events
+            self._dumps = json.dumps
+            self._file = open(self.path, 'a')
+        for event, callback in self._callbacks.items():
+            add_hook(event, callback)
+        return self
+
+    def uninstall(self):
+        "Unregisters hooks and closes the file, or writes histograms."
+        for event, callback in self._callbacks.items():
+            remove_hook(event, callback)
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def flush(self):
+        "Flushes written events, or writes histograms."
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            if self.histograms:
+                with open(self.path, 'w') as out:
+                    out.write(self._histogram_text())
+
+    def _write(self, event, func, line, **record):
+        "Appends event to the file, if it's sampled."
+        if not next(self._sample):
+            return
+        record.update(event=event, function=func.__name__, line=line,
+                      thread=threading.current_thread().ident)
+        record.setdefault('time', time.time())
+        if self.context is not None:
+            record['context'] = self.context()
+        text = self._dumps(record, sort_keys=True, default=repr) + '\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(text)
+
+    def _span(self, func, clause, duration, error):
+        self._write('clause', func, _clause_line(clause), time=time.time() - duration, duration=duration,
+                    error=None if error is None else type(error).__name__)
+
+    def _miss(self, func, args, kwargs):
+        self._write('match_miss', func, None, arity=len(args) + len(kwargs))
+
+    def _guard_rejected(self, guarded, arg_name, value):
+        self._write('guard_rejected', guarded, _clause_line(guarded), argument=arg_name)
+
+    def _relguard_rejected(self, guarded, arguments):
+        self._write('relguard_rejected', guarded, _clause_line(guarded))
+
+    def _count_duration(self, func, clause, duration, error):
+        key = (func.__name__, _clause_line(clause))
+        with self._lock:
+            counts = self._durations.get(key)
+            if counts is None:
+                counts = self._durations[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, duration)] += 1
+            counts[-1] += duration
+
+    def _count_miss(self, func, args, kwargs):
+        with self._lock:
+            self._misses[func.__name__] += 1
+
+    def _histogram_text(self):
+        "Returns histograms and counters in Prometheus text format."
+        lines = ['# HELP fpm_clause_duration_seconds Time spent running clauses of multi-claused functions.',
+                 '# TYPE fpm_clause_duration_seconds histogram']
+        for (name, line), counts in sorted(self._durations.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            labels = 'function="%s",line="%s"' % (name, line)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('fpm_clause_duration_seconds_bucket{%s,le="%s"} %i' % (labels, bound, total))
+            lines.append('fpm_clause_duration_seconds_sum{%s} %r' % (labels, counts[-1]))
+            lines.append('fpm_clause_duration_seconds_count{%s} %i' % (labels, total))
+        lines += ['# HELP fpm_match_misses_total Calls of multi-claused functions that no clause matched.',
+                  '# TYPE fpm_match_misses_total counter']
+        for name, misses in sorted(self._misses.items()):
+            lines.append('fpm_match_misses_total{function="%s"} %i' % (name, misses))
+        return '\n'.join(lines) + '\n'
+
+# CASE #
+
+_min_indexed_run = 4 # shorter runs of constant-value or type dispatching clauses are just tried one by one.
+_type_cache_size = 1024 # max number of argument type tuples cached by a `_TypeIndex`
+
+def _value_pattern(clause, arity):
+    """
+    Returns tuple of values clause's arguments have to be equal to (`_` where any value matches), or None if clause
+    matches on something else than equality with hashable constants.
+    """
+    if hasattr(clause, '__catchall__'):
+        return (_,) * arity
+    if getattr(clause, '_relguard', None) is not _ or len(clause._argument_guards) != arity:
+        return None
+
+    pattern = []
+    for grd in clause._argument_guards.values():
+        if isinstance(grd, GuardFunc):
+            grd = _simplify(grd)
+            if grd.op == 'eq' and type(grd.operands[0]) in _hash_safe_types and grd.operands[0] == grd.operands[0]:
+                grd = grd.operands[0] # NaN excluded above, as lookup would find it, while `==` wouldn't.
+            elif grd.op == '_':
+                grd = _
+            else:
+                return None
+        elif grd is not _:
+            return None
+        pattern.append(grd)
+    return tuple(pattern)
+
+class _ValueIndex():
+    """
+    Index of a run of clauses which match only on equality of arguments with hashable constants (or `_`). Finds the
+    first clause of the run that can match given positional arguments with a dict lookup for each distinct set of
+    `_` positions.
+    """
+    def __init__(self, patterns):
+        tables = OrderedDict() # positions of constants -> {constants: position of first clause with them}
+        for pos, pattern in enumerate(patterns):
+            positions = tuple(i for i, val in enumerate(pattern) if val is not _)
+            tables.setdefault(positions, {}).setdefault(tuple(pattern[i] for i in positions), pos)
+
+        # tables are in order of their first clause, so lookups can stop as soon as no better candidate is possible.
+        self.tables = tuple((min(table.values()), positions, table) for positions, table in tables.items())
+        self.checked = tuple(sorted(set().union(*tables)))
+        self.size = len(patterns)
+
+    def candidates(self, args):
+        "Returns positions of clauses that can match args: from the first one that does onwards."
+        for i in self.checked:
+            if type(args[i]) not in _hash_safe_types:
+                return six.moves.range(self.size) # lookup might not agree with `==`, every clause has to be tried.
+
+        best = self.size
+        for first, positions, table in self.tables:
+            if first >= best:
+                break
+            best = min(best, table.get(tuple(args[i] for i in positions), best))
+        return six.moves.range(best, self.size)
+
+def _cacheable_types(spec):
+    """
+    Checks if result of `isinstance(inp, spec)` depends only on type of inp, so it can be cached for that type.
+    Subclass hooks and registered virtual subclasses of ABCs are fine, as long as ABC cache token is available.
+    """
+    if isinstance(spec, tuple):
+        return all(_cacheable_types(item) for item in spec)
+    if not isinstance(spec, type):
+        return False
+    instancecheck = type(spec).__instancecheck__
+    if instancecheck is type.__instancecheck__:
+        return True
+    return instancecheck is abc.ABCMeta.__instancecheck__ and hasattr(abc, 'get_cache_token')
+
+def _type_pattern(clause, arity):
+    """
+    Returns tuple with, for each argument, types it has to be an instance of (as a tuple of `isoftype` specs, or
+    None if any type matches), or None if clause doesn't dispatch on types. The rest of clause's guards and its
+    relguard have to be checked separately.
+    """
+    if hasattr(clause, '__catchall__'):
+        return (None,) * arity
+    if len(getattr(clause, '_argument_guards', ())) != arity:
+        return None
+
+    pattern = []
+    for grd in clause._argument_guards.values():
+        specs = ()
+        if isinstance(grd, GuardFunc):
+            grd = _simplify(grd)
+            specs = tuple(part.operands[0] for part in (grd.operands if grd.op == 'and' else (grd,))
+                          if part.op == 'isoftype' and _cacheable_types(part.operands[0]))
+        pattern.append(specs or None)
+    return tuple(pattern) if any(pattern) else None
+
+def _abcs(spec):
+    "Checks if any of types in `isoftype` spec is an abstract base class."
+    if isinstance(spec, tuple):
+        return any(_abcs(item) for item in spec)
+    return isinstance(spec, abc.ABCMeta)
+
+_get_class = operator.attrgetter('__class__')
+
+class _TypeIndex():
+    """
+    Index of a run of clauses which dispatch on argument types. Like `functools.singledispatch`, it caches which
+    clauses have matching type patterns for each tuple of argument types (and of their `__class__`es, if any
+    differs); only those clauses are tried.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.cache = {}
+        self.cache_token = None
+        self.abcs = any(_abcs(spec) for pattern in patterns for specs in pattern if specs for spec in specs)
+
+    def candidates(self, args):
+        "Returns positions of clauses whose type patterns match args."
+        if self.abcs: # registering a virtual subclass of any ABC changes the token
+            token = abc.get_cache_token()
+            if token != self.cache_token:
+                self.cache.clear()
+                self.cache_token = token
+
+        key = tuple(map(type, args))
+        classes = tuple(map(_get_class, args))
+        if classes != key: # proxies overriding `__class__`, which isinstance checks as well
+            key = (key, classes)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        candidates = tuple(pos for pos, pattern in enumerate(self.patterns)
+                           if all(specs is None or all(isinstance(arg, spec) for spec in specs)
+                                  for arg, specs in zip(args, pattern)))
+        if len(self.cache) >= _type_cache_size:
+            self.cache.clear()
+        self.cache[key] = candidates
+        return candidates
+
+def _clause_parts(clause):
+    """
+    Returns `(matches, body)` pair for a clause. `matches` checks clause's guards without raising GuardError, and
+    `body` is called once it returns True. Body is the undecorated function (or one passing it values captured by
+    patterns and iterators checked by `each`), unless something else than `guard` wraps it, in which case it's the
+    clause itself (its guards will pass then).
+    """
+    if hasattr(clause, '__catchall__'):
+        return (_, clause) # _ takes any arguments and returns True
+    if getattr(clause, '_validate', None) is not None:
+        _validate(clause)
+    if getattr(clause._matches, '_wrapper', None) is clause:
+        return (clause._matches, clause._body or clause.__guarded__)
+    return (clause._matches, clause)
+
+class _Plan():
+    """
+    Clauses of one arity split into runs of `(clauses, index)`, where clauses are `(matches, body)` pairs (see
+    `_clause_parts`). Runs of clauses matching only on constant values get a `_ValueIndex`, runs of clauses
+    dispatching on types get a `_TypeIndex`, others have None instead and are tried one by one.
+    """
+    def __init__(self, clauses, arity):
+        indexed = []
+        for clause in clauses:
+            pattern = _value_pattern(clause, arity)
+            if pattern is not None:
+                indexed.append((_clause_parts(clause), _ValueIndex, pattern))
+                continue
+            pattern = _type_pattern(clause, arity)
+            indexed.append((_clause_parts(clause), _TypeIndex if pattern is not None else None, pattern))
+
+        runs = []
+        for index_class, run in itertools.groupby(indexed, key=lambda item: item[1]):
+            run_clauses, _index_classes, patterns = map(tuple, zip(*run))
+            if index_class is not None and len(run_clauses) >= _min_indexed_run:
+                runs.append((run_clauses, index_class(patterns)))
+            elif runs and runs[-1][1] is None: # merge with preceding run of clauses that are tried one by one
+                runs[-1] = (runs[-1][0] + run_clauses, None)
+            else:
+                runs.append((run_clauses, None))
+        self.runs = tuple(runs)
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, or None."
+        for clauses, index in self.runs:
+            # skip clauses of indexed run which can't match, try the rest in order
+            for i in (index.candidates(args) if index is not None and not kwargs else six.moves.range(len(clauses))):
+                matches, body = clauses[i]
+                if matches(*args, **kwargs):
+                    return body
+        return None
+
+_timer = getattr(time, 'perf_counter', time.time) # py<3.3
+
+def _clause_line(clause):
+    "Returns first line of clause's code, or None if it has no code."
+    return getattr(getattr(getattr(clause, '__guarded__', clause), '__code__', None), 'co_firstlineno', None)
+
+class _ClauseStats(object):
+    "Counters of a clause, see `MultiFunc.stats`."
+    __slots__ = ('line', 'tried', 'matched', 'guard_time', 'body_time')
+
+    def __init__(self, clause):
+        self.line = _clause_line(clause)
+        self.tried = self.matched = 0
+        self.guard_time = self.body_time = 0.0
+
+    def timed(self, body):
+        "Returns function calling body and adding time it took to `body_time`."
+        @six.wraps(body)
+        def timed_body(*args, **kwargs):
+            started = _timer()
+            try:
+                return body(*args, **kwargs)
+            finally:
+                self.body_time += _timer() - started
+        return timed_body
+
+class _StatsPlan(_Plan):
+    """
+    `_Plan` which counts how many times each clause was tried and matched, and measures time spent on checking its
+    guards and running it. Counters survive rebuilding the plan after a clause is appended.
+    """
+    def __init__(self, clauses, arity, stats):
+        _Plan.__init__(self, clauses, arity)
+        self.stats = stats
+        for clause in clauses[len(stats['clauses']):]:
+            stats['clauses'].append(_ClauseStats(clause))
+
+        # each run gets counters of its clauses and their bodies wrapped for timing, in the same order
+        counters = iter(stats['clauses'])
+        self.runs = tuple((tuple((matches, counter, counter.timed(body))
+                                 for (matches, body), counter in zip(clauses, counters)), index)
+                          for clauses, index in self.runs)
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, or None, and counts what happened."
+        for clauses, index in self.runs:
+            for i in (index.candidates(args) if index is not None and not kwargs else six.moves.range(len(clauses))):
+                matches, counter, body = clauses[i]
+                started = _timer()
+                passed = matches(*args, **kwargs)
+                counter.guard_time += _timer() - started
+                counter.tried += 1
+                if passed:
+                    counter.matched += 1
+                    return body
+        self.stats['misses'] += 1
+        return None
+
+class _HookedPlan(object):
+    """
+    Wraps selector of a MultiFunc to call hooks (see `add_hook`): 'clause_selected' or 'match_miss' once the call
+    found its clause or none, and 'clause_start' and 'clause_end' around the clause's run. Only used while any of
+    these events has callbacks.
+    """
+    def __init__(self, func, clauses, select):
+        self.func = func
+        self.select_body = select
+        self.clauses = dict((_clause_parts(clause)[1], clause) for clause in reversed(clauses)) # body -> first clause
+        self.bodies = {} # body returned by select -> (clause, body calling hooks around it)
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, wrapped to call hooks, or None, and calls hooks."
+        body = self.select_body(args, kwargs)
+        if body is None:
+            _emit('match_miss', self.func, args, kwargs)
+            return None
+        try:
+            clause, hooked = self.bodies[body]
+        except KeyError: # bodies timed by `_StatsPlan` wrap clauses' bodies
+            clause = self.clauses.get(body) or self.clauses.get(getattr(body, '__wrapped__', None))
+            clause, hooked = self.bodies[body] = (clause, self.hooked(clause, body))
+        _emit('clause_selected', self.func, clause, args, kwargs)
+        return hooked
+
+    def hooked(self, clause, body):
+        "Returns function calling body between 'clause_start' and 'clause_end' hooks."
+        func = self.func
+
+        def hooked_body(*args, **kwargs):
+            _emit('clause_start', func, clause, args, kwargs)
+            started = _timer()
+            try:
+                result = body(*args, **kwargs)
+            except BaseException as error:
+                _emit('clause_end', func, clause, _timer() - started, error)
+                raise
+            _emit('clause_end', func, clause, _timer() - started, None)
+            return result
+        return hooked_body
+
+_adapt_every = 256 # matches in a group of disjoint clauses between reorderings
+_layout_types = (bool, float, complex, list, tuple, dict, set, frozenset, bytearray, six.text_type,
+                 six.binary_type) + six.integer_types # builtins with incompatible instance layouts
+
+def _ordered_domain(val):
+    "Returns name of a set of values totally ordered together with val, or None (for NaN, None, complex, ...)."
+    if type(val) in six.integer_types + (bool, float) and val == val:
+        return 'number'
+    if type(val) in (six.text_type, six.binary_type):
+        return type(val).__name__
+    return None
+
+def _clause_region(clause, arity):
+    """
+    Returns, for each argument of clause, a dict describing what it has to be to pass clause's guards: 'eq' -- hashable
+    constant it's equal to, 'low' and 'high' -- `(bound, inclusive)` it's within, and 'types' -- list of `isoftype`
+    specs it's an instance of. None for catch-all clauses, and for clauses with a relguard or custom guards, whose tests
+    may have side effects or raise, so they're run in definition order.
+    """
+    if hasattr(clause, '__catchall__') or len(getattr(clause, '_argument_guards', ())) != arity:
+        return None
+    if getattr(clause, '_relguard', None) is not _ or not all(map(_safe, clause._argument_guards.values())):
+        return None
+
+    region = []
+    for grd in clause._argument_guards.values():
+        constraints = {'eq': _, 'low': None, 'high': None, 'types': []}
+        if isinstance(grd, GuardFunc):
+            grd = _simplify(grd)
+            parts = []
+            for part in (grd.operands if grd.op == 'and' else (grd,)):
+                parts.extend(part.operands if part.op == 'between' else (part,))
+            for part in parts:
+                val = part.operands[0] if part.operands else None
+                if part.op == 'eq' and type(val) in _hash_safe_types and val == val:
+                    constraints['eq'] = val
+                elif part.op in _lower_bounds and _ordered_domain(val) and constraints['low'] is None:
+                    constraints['low'] = (val, part.op == 'ge')
+                elif part.op in _upper_bounds and _ordered_domain(val) and constraints['high'] is None:
+                    constraints['high'] = (val, part.op == 'le')
+                elif part.op == 'isoftype':
+                    constraints['types'].append(val)
+        region.append(constraints)
+    return region
+
+def _interval(constraints):
+    "Returns `(domain, low, high)` interval of values satisfying constraints, or None if it's unknown."
+    if constraints['eq'] is not _:
+        domain = _ordered_domain(constraints['eq'])
+        return (domain, (constraints['eq'], True), (constraints['eq'], True)) if domain else None
+    low, high = constraints['low'], constraints['high']
+    domains = set(_ordered_domain(bound[0]) for bound in (low, high) if bound is not None)
+    return (domains.pop(), low, high) if len(domains) == 1 else None
+
+def _below(high, low):
+    "Checks if upper bound `high` is below lower bound `low`, so no value is within both."
+    return high[0] < low[0] or high[0] == low[0] and not (high[1] and low[1])
+
+def _values_disjoint(first, second):
+    "Checks if no argument of hashable type can pass both constraints on values."
+    if first['eq'] is not _ and second['eq'] is not _:
+        return first['eq'] != second['eq']
+    first, second = _interval(first), _interval(second)
+    if first is None or second is None:
+        return False
+    if first[0] != second[0]: # values of other domains are unorderable, so can't be within both intervals
+        return six.PY3
+    return (first[2] is not None and second[1] is not None and _below(first[2], second[1]) or
+            second[2] is not None and first[1] is not None and _below(second[2], first[1]))
+
+def _solid_base(cls):
+    "Returns builtin type that determines instance layout of cls, or None."
+    return next((base for base in cls.__mro__ if base in _layout_types), None)
+
+def _types_disjoint(first, second):
+    """
+    Checks if no object whose `__class__` is its type can be an instance of all `isoftype` specs in both lists: some
+    types in them have no common subclass, because either is final or their layouts conflict.
+    """
+    def exclusive(one, other):
+        if not all(isinstance(cls, type) and type(cls).__instancecheck__ is type.__instancecheck__
+                   for cls in (one, other)):
+            return False
+        if issubclass(one, other) or issubclass(other, one):
+            return False
+        if not one.__flags__ & 1 << 10 or not other.__flags__ & 1 << 10: # no Py_TPFLAGS_BASETYPE
+            return True
+        bases = (_solid_base(one), _solid_base(other))
+        if None in bases or bases[0] is bases[1]:
+            return False
+        try:
+            type('_', bases, {}) # only builtins, so no user code runs
+        except TypeError:
+            return True
+        return False
+
+    def union(spec):
+        return spec if isinstance(spec, tuple) else (spec,)
+
+    return any(all(exclusive(one, other) for one in union(first_spec) for other in union(second_spec))
+               for first_spec in first for second_spec in second)
+
+def _disjoint(first, second):
+    """
+    Tries to prove that no arguments can pass guards of both clauses, given their regions (see `_clause_region`).
+    Returns `(safe, plain)` pair of sets of argument positions: proof holds if arguments at `safe` are of hashable
+    type and arguments at `plain` don't fake their `__class__`. Returns None if there's no proof.
+    """
+    if first is None or second is None:
+        return None
+    for pos, (one, other) in enumerate(zip(first, second)):
+        if _types_disjoint(one['types'], other['types']):
+            return (set(), {pos})
+    for pos, (one, other) in enumerate(zip(first, second)):
+        if _values_disjoint(one, other):
+            return ({pos}, set())
+    return None
+
+class _DisjointGroup(object):
+    "Consecutive clauses, no two of which can match the same arguments, tried in order of how often they matched."
+    def __init__(self, clause, region):
+        self.clauses = [_clause_parts(clause)]
+        self.regions = [region]
+        self.safe, self.plain = (), () # argument positions, see `_disjoint`
+        self.order = (0,)
+        self.hits = [0]
+        self.matched = 0
+
+    def add(self, clause, region):
+        "Adds clause to group if it's disjoint with all its clauses. Returns whether it was added."
+        proofs = [_disjoint(other, region) for other in self.regions]
+        if None in proofs:
+            return False
+        for safe, plain in proofs:
+            self.safe = tuple(set(self.safe) | safe)
+            self.plain = tuple(set(self.plain) | plain)
+        self.clauses.append(_clause_parts(clause))
+        self.regions.append(region)
+        self.order += (len(self.order),)
+        self.hits.append(0)
+        return True
+
+    def adaptable(self, args):
+        "Checks if arguments are such that clauses of group are disjoint for them, so their order doesn't matter."
+        for pos in self.safe:
+            if type(args[pos]) not in _hash_safe_types:
+                return False
+        for pos in self.plain:
+            if args[pos].__class__ is not type(args[pos]):
+                return False
+        return True
+
+    def reorder(self):
+        "Sorts clauses by number of matches. Called after every `_adapt_every` matches."
+        self.order = tuple(sorted(self.order, key=lambda i: -self.hits[i]))
+        self.hits = [hits // 2 for hits in self.hits] # so that order follows changes of traffic
+        self.matched = 0
+
+class _AdaptivePlan():
+    """
+    Clauses of one arity split into groups of consecutive clauses which provably can't match the same arguments
+    (like `eq` on different values, disjoint ranges or `isoftype` on types with no common subclass). Clauses of
+    a group are tried starting from the one which matched most often, others keep their order, so the result is
+    the same as if clauses were tried in order. Clauses with a relguard or custom guards are never reordered.
+    """
+    def __init__(self, clauses, arity):
+        self.groups = []
+        for clause in clauses:
+            region = _clause_region(clause, arity)
+            if not self.groups or not self.groups[-1].add(clause, region):
+                self.groups.append(_DisjointGroup(clause, region))
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, or None."
+        for group in self.groups:
+            clauses = group.clauses
+            if len(clauses) > 1 and not kwargs and group.adaptable(args):
+                for pos in group.order:
+                    matches, body = clauses[pos]
+                    if matches(*args):
+                        group.hits[pos] += 1
+                        group.matched += 1
+                        if group.matched >= _adapt_every:
+                            group.reorder()
+                        return body
+            else:
+                for matches, body in clauses:
+                    if matches(*args, **kwargs):
+                        return body
+        return None
+
+def _has_async(clauses):
+    "Checks if any of clauses is a coroutine function or has guards that have to be awaited."
+    return any(_iscoroutinefunction(part) for clause in clauses for part in _clause_parts(clause))
+
+class _AsyncPlan():
+    """
+    Clauses of one arity, of which some are coroutine functions or have guards that have to be awaited. They're tried
+    one by one in a coroutine, which awaits whatever needs it and returns result of the matched clause.
+    """
+    def __init__(self, clauses, no_match):
+        src = _Source({})
+        clauses = src.inject('_fpm_clauses', tuple(
+                (matches, _iscoroutinefunction(matches), body, _iscoroutinefunction(body))
+                for matches, body in map(_clause_parts, clauses)))
+        self.call = src.compile('call', '*args, **kwargs', [
+            'for matches, awaits_match, body, awaits_body in %s:' % clauses,
+            '    if (await matches(*args, **kwargs)) if awaits_match else matches(*args, **kwargs):',
+            '        return (await body(*args, **kwargs)) if awaits_body else body(*args, **kwargs)',
+            'raise %s(args, kwargs)' % src.inject('_fpm_no_match', no_match),
+        ], '<async dispatch>', is_async=True)
+
+    def select(self, args, kwargs):
+        "Returns coroutine function, which finds the matching clause and awaits it."
+        return self.call
+
+_tree_node_limit = 4096 # tests and switches a `_DecisionTree` may have; the rest of clauses are tried one by one.
+_tree_depth_limit = 256
+
+def _value_key(val):
+    "Returns hashable key, equal for equal values of the same type (or just for the same value if unhashable)."
+    try:
+        hash(val)
+    except TypeError:
+        return ('id', id(val))
+    return (type(val), val)
+
+def _guard_key(grd):
+    "Returns hashable key, equal for structurally equal guards."
+    return (grd.op,) + tuple(_guard_key(operand) if isinstance(operand, GuardFunc) else _value_key(operand)
+                             for operand in grd.operands)
+
+def _clause_tests(clause, arity):
+    """
+    Splits clause's guards into tests that all have to pass for clause to match. Returns list of
+    `(key, position, check, value)` tuples, where `check` is applied to argument at `position`, or to tuple of all
+    arguments if position is None (relguard). Equivalent tests have the same key. `value` is a hashable constant
+    the argument has to be equal to, or `_` if the test is something else.
+    """
+    if hasattr(clause, '__catchall__'):
+        return []
+
+    tests = []
+    for position, grd in enumerate(clause._argument_guards.values()):
+        if grd is _:
+            continue
+        if not isinstance(grd, GuardFunc):
+            tests.append((('callable', position, id(grd)), position, grd, _))
+            continue
+        grd = _simplify(grd)
+        for part in (grd.operands if grd.op == 'and' else (grd,)):
+            if part.op == '_':
+                continue
+            value = part.operands[0] if part.op == 'eq' else _
+            if type(value) not in _hash_safe_types or value != value:
+                value = _
+            tests.append(((position,) + _guard_key(part), position, part.test, value))
+
+    rel_guard = clause._relguard
+    if rel_guard is not _: # checked last, as it's usually the costliest test
+        names = tuple(clause._argument_guards)
+        tests.append((('relguard', id(rel_guard)), None, lambda args: rel_guard(**dict(zip(names, args))), _))
+    return tests
+
+def _assume(state, known):
+    """
+    Returns state of `_DecisionTree` construction after learning results of tests in `known` (key -> bool): clauses
+    with a failed test are dropped, passed tests are no longer pending.
+    """
+    return tuple((pos, tuple(key for key in keys if key not in known)) for pos, keys in state
+                 if not any(known.get(key) is False for key in keys))
+
+_TEST, _SWITCH, _LEAF, _LINEAR = range(4) # kinds of `_DecisionTree` nodes
+
+class _DecisionTree():
+    """
+    Clauses of one arity compiled to a decision tree, which evaluates every distinct test at most once per call, no
+    matter how many clauses share it, and switches on hashable constants with a single dict lookup.
+
+    Nodes are tuples:
+        (_TEST, check, position, if_passed, if_failed)
+        (_SWITCH, position, {value: node}, if_none_equal, if_unhashable)
+        (_LEAF, body) -- body is None if no clause matches
+        (_LINEAR, ((tests, body), ...)) -- clauses left to try one by one, once tree has grown too big
+
+    Result is the same as trying clauses in order, as long as guards have no side effects. Calls with keyword
+    arguments fall back to `_Plan`.
+    """
+    def __init__(self, clauses, arity, fallback):
+        self.fallback = fallback
+        self.tests = {} # key -> (position, check, value)
+        self.bodies = []
+        state = []
+        for pos, clause in enumerate(clauses):
+            keys = []
+            for key, position, check, value in _clause_tests(clause, arity):
+                self.tests.setdefault(key, (position, check, value))
+                if key not in keys:
+                    keys.append(key)
+            self.bodies.append(_clause_parts(clause)[1])
+            state.append((pos, tuple(keys)))
+
+        self.size = 0
+        self._built = {} # state -> node, shares equal subtrees
+        self.root = self._build(tuple(state), 0)
+        del self._built
+
+    def _build(self, state, depth):
+        "Returns node choosing the first clause in state that passes its pending tests."
+        try:
+            return self._built[state]
+        except KeyError:
+            pass
+
+        if not state:
+            node = (_LEAF, None)
+        elif not state[0][1]: # every test of the first clause passed
+            node = (_LEAF, self.bodies[state[0][0]])
+        elif self.size >= _tree_node_limit or depth >= _tree_depth_limit:
+            node = self._linear(state)
+        else:
+            self.size += 1
+            key = state[0][1][0]
+            position, check, value = self.tests[key]
+            if value is _:
+                node = (_TEST, check, position,
+                        self._build(_assume(state, {key: True}), depth + 1),
+                        self._build(_assume(state, {key: False}), depth + 1))
+            else: # switch over all constants this argument is compared with
+                groups = {} # value -> keys of tests passing for it (1, 1.0 and True fall into one group)
+                for _pos, keys in state:
+                    for other in keys:
+                        other_position, _check, other_value = self.tests[other]
+                        if other_position == position and other_value is not _:
+                            groups.setdefault(other_value, set()).add(other)
+                eq_keys = set().union(*groups.values())
+                table = {}
+                for other_value, passed in groups.items():
+                    table[other_value] = self._build(
+                        _assume(state, dict((other, other in passed) for other in eq_keys)), depth + 1)
+                node = (_SWITCH, position, table,
+                        self._build(_assume(state, dict.fromkeys(eq_keys, False)), depth + 1),
+                        self._linear(state)) # lookup might not agree with `==` on other types
+        self._built[state] = node
+        return node
+
+    def _linear(self, state):
+        "Returns node trying clauses in state one by one."
+        return (_LINEAR, tuple((tuple(self.tests[key][:2] for key in keys), self.bodies[pos]) for pos, keys in state))
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, or None."
+        if kwargs:
+            return self.fallback.select(args, kwargs)
+
+        node = self.root
+        while True:
+            kind = node[0]
+            if kind == _TEST:
+                node = node[3] if node[1](args if node[2] is None else args[node[2]]) else node[4]
+            elif kind == _SWITCH:
+                arg = args[node[1]]
+                node = node[2].get(arg, node[3]) if type(arg) in _hash_safe_types else node[4]
+            elif kind == _LEAF:
+                return node[1]
+            else:
+                for tests, body in node[1]:
+                    if all(check(args if position is None else args[position]) for position, check in tests):
+                        return body
+                return None
+
+def _clause_rows(numpy, clause, columns, rows):
+    "Returns those of `rows` (indices into 1-d `columns`, one for each argument) that pass clause's guards."
+    if hasattr(clause, '__catchall__'):
+        return rows
+
+    for column, grd in zip(columns, clause._argument_guards.values()):
+        if grd is _ or not len(rows):
+            continue
+        if isinstance(grd, GuardFunc):
+            passed = _mask(numpy, _simplify(grd), column[rows], items=True) # rows are passed on as Python values
+        else:
+            passed = numpy.array([bool(grd(value)) for value in column[rows].tolist()], dtype=bool)
+        rows = rows[passed]
+
+    if clause._relguard is not _ and len(rows):
+        names = tuple(clause._argument_guards)
+        passed = [bool(clause._relguard(**dict(zip(names, row))))
+                  for row in zip(*[column[rows].tolist() for column in columns])]
+        rows = rows[numpy.array(passed, dtype=bool)]
+    return rows
+
+def _args_key(args, kwargs):
+    """
+    Returns key equal for calls with equal arguments of the same types, as `f(1)`, `f(1.0)` and `f(True)` may well
+    match different clauses. Hashing it raises TypeError if any argument is unhashable.
+    """
+    types = tuple(map(type, args))
+    classes = tuple(map(_get_class, args))
+    key = args + (types if classes == types else types + (_get_class,) + classes) # proxies, see `_TypeIndex`
+    if kwargs:
+        key += (_args_key,) + tuple(sorted((name, type(value), value.__class__, value)
+                                           for name, value in kwargs.items()))
+    return key
+
+_decision_cache_size = 1024 # default max number of argument tuples cached by a `_DecisionCache`
+_identity_safe_types = (type(None), bool) # equal values of these types are the same object
+
+def _checks_identity(clause):
+    """
+    Checks if any guard of clause tells equal arguments apart by identity (`Is` or `Isnot`), so `_args_key` can't
+    stand for them.
+    """
+    def identity(grd):
+        if not isinstance(grd, GuardFunc):
+            return False
+        if grd.op in ('Is', 'Isnot'):
+            return type(grd.operands[0]) not in _identity_safe_types
+        return any(identity(operand) for operand in grd.operands)
+    return any(identity(grd) for grd in getattr(clause, '_argument_guards', {}).values())
+
+def _has_iterators(args, kwargs):
+    "Checks if any argument is an iterator, e.g. a generator, which the call consumes, so it can't be called again."
+    for arg in itertools.chain(args, kwargs.values()):
+        try:
+            if iter(arg) is arg:
+                return True
+        except TypeError:
+            pass
+    return False
+
+class _DecisionCache():
+    """
+    Remembers which clause body another selector returned for each tuple of hashable arguments, so that repeated
+    calls check no guards at all, see `MultiFunc.enable_decision_cache`. Like `_TypeIndex`, it's emptied once full,
+    and, being dropped with the selector, whenever a clause is appended.
+    """
+    def __init__(self, select, maxsize):
+        self.fallback = select
+        self.maxsize = maxsize
+        self.bodies = {}
+
+    def select(self, args, kwargs):
+        "Returns body of the first clause matching arguments, or None."
+        key = _args_key(args, kwargs)
+        try:
+            return self.bodies[key]
+        except KeyError:
+            pass
+        except TypeError: # unhashable
+            return self.fallback(args, kwargs)
+
+        body = self.fallback(args, kwargs)
+        if _has_iterators(args, kwargs): # equal only to itself, key would just keep it alive
+            return body
+        if len(self.bodies) >= self.maxsize:
+            self.bodies.clear()
+        self.bodies[key] = body
+        return body
+
+class _HashedKey(object):
+    """
+    Key of `_Memo`, hashed once when made, and equal to itself without comparing arguments, so that looking it up runs
+    no `__hash__` and hardly any `__eq__` of arguments while the lock is held.
+    """
+    __slots__ = ('key', 'hash')
+
+    def __init__(self, key):
+        self.key = key
+        self.hash = hash(key) # raises TypeError if any argument is unhashable
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self is other or (self.hash == other.hash and self.key == other.key)
+
+    def __ne__(self, other):
+        return not self == other
+
+class _Memo():
+    """
+    Bounded LRU cache of results of a pure MultiFunc, see `MultiFunc.enable_memoize`. Calls with unhashable or iterator
+    arguments and calls returning awaitables are never cached.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize # None means unbounded
+        self.results = OrderedDict() # `_HashedKey` -> result, least recently used first
+        self.lock = threading.RLock() # `__eq__` of arguments might call func again
+        self.generation = 0 # bumped by `clear`, so that results computed by calls running meanwhile aren't stored
+        self.hits = self.misses = self.unhashable = 0
+
+    def call(self, func, args, kwargs):
+        "Returns cached result of `func(*args, **kwargs)`, or dispatches the call and caches what it returns."
+        try:
+            key = _HashedKey(_args_key(args, kwargs)) # not under lock, as `__hash__` of arguments might call func again
+        except TypeError: # unhashable
+            key = None
+        if key is None or _has_iterators(args, kwargs): # iterators are consumed by the call, so can't be called again
+            with self.lock:
+                self.unhashable += 1
+            return func._run(args, kwargs)
+
+        try:
+            with self.lock:
+                result = self.results.pop(key)
+                self.results[key] = result # most recently used now
+                self.hits += 1
+                return result
+        except KeyError:
+            pass
+
+        with self.lock:
+            self.misses += 1
+            generation = self.generation
+        result = func._run(args, kwargs)
+        if hasattr(result, '__await__'):
+            return result
+
+        with self.lock:
+            if generation == self.generation:
+                self.results[key] = result
+                if self.maxsize is not None and len(self.results) > self.maxsize:
+                    self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        "Drops all cached results."
+        with self.lock:
+            self.results.clear()
+            self.generation += 1
+
+    def info(self):
+        "Returns counters, see `MultiFunc.cache_info`."
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'unhashable': self.unhashable,
+                    'maxsize': self.maxsize, 'size': len(self.results)}
+
+class TailCall(object):
+    """
+    Call of `func` with given arguments. Return it from a clause of a MultiFunc with tail calls enabled (see
+    `MultiFunc.enable_tail_calls`) instead of making the call, and MultiFunc makes it in a loop, so that stack doesn't
+    grow however deep the recursion goes.
+    """
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return 'TailCall(%s, *%r, **%r)' % (getattr(self.func, '__name__', self.func), self.args, self.kwargs)
+
+def _trampoline(result):
+    """
+    Makes tail calls until one returns something else, and returns that. Clauses of MultiFuncs are called directly
+    (unless results are memoized), so each step costs the same few frames, which are gone before the next one.
+    """
+    while isinstance(result, TailCall):
+        func = result.func
+        if isinstance(func, MultiFunc) and func._memo is None:
+            result = func._dispatch(result.args, result.kwargs)
+        else:
+            result = func(*result.args, **result.kwargs)
+    return result
+
+def _part_repr(op, key):
+    "Returns source of getting part of a value, e.g. `[0]`, for accessor node (see `_captures`)."
+    if op == 'item':
+        return '[%r]' % (key,)
+    if op == 'attr':
+        return '.%s' % key if _is_identifier(key) else '.<%s>' % key
+    return '[%i:]' % key
+
+def _guard_rejection(grd, value, where):
+    """
+    Returns text telling which part of guard rejects value (named by `where`), down to the failing part of a
+    structural pattern or element of a container, or None if value passes. Operands of `&` are checked in the order
+    they were written, not in the order of `_simplify`.
+    """
+    if _is_async(grd):
+        return "%s has an async guard, which can't be checked here" % where
+    if not isinstance(grd, GuardFunc):
+        return None if grd(value) else '%s = %s failed %s' % (where, _value_repr(value), getattr(grd, '__name__', grd))
+    if grd.test(value):
+        return None
+
+    if grd.op == 'and':
+        for operand in grd.operands:
+            reason = _guard_rejection(operand, value, where)
+            if reason is not None:
+                return reason
+    elif grd.op == 'bind':
+        return _guard_rejection(grd.operands[1], value, where)
+    elif grd.op in _accessors:
+        op, key = grd.op, grd.operands[0]
+        try:
+            part = value[key] if op == 'item' else getattr(value, key) if op == 'attr' else value[key:]
+        except (LookupError, TypeError, AttributeError):
+            return '%s = %s has no %s' % (where, _value_repr(value), _part_repr(op, key))
+        return _guard_rejection(grd.operands[1], part, where + _part_repr(op, key))
+    elif grd.op == 'each' and isinstance(value, (list, tuple, set, frozenset, dict)):
+        for i, item in enumerate(value):
+            reason = _guard_rejection(grd.operands[0], item, '%s[%i]' % (where, i) if isinstance(value, (list, tuple))
+                                      else 'element %i of %s' % (i, where))
+            if reason is not None:
+                return reason
+    return '%s = %s failed %r' % (where, _value_repr(value), grd)
+
+def _value_repr(value):
+    "Returns repr of value, shortened."
+    return six.moves.reprlib.repr(value)
+
+def _clause_rejection(clause, args, kwargs):
+    "Returns text telling why clause doesn't match arguments, or None if it does. See `MultiFunc.explain`."
+    if hasattr(clause, '__catchall__'):
+        return None
+    names = list(clause._argument_guards)
+    if (len(args) > len(names) or any(name not in names[len(args):] for name in kwargs)):
+        return "arguments don't fit its parameters (%s)" % ', '.join(names)
+    values = dict(zip(names, args))
+    values.update(kwargs)
+
+    for name, grd in clause._argument_guards.items():
+        if grd is not _:
+            reason = _guard_rejection(grd, values[name], name)
+            if reason is not None:
+                return reason
+    rel_guard = clause._relguard
+    if rel_guard is _:
+        return None
+    if _is_async(rel_guard):
+        return "it has an async relguard, which can't be checked here"
+    if not rel_guard(**values):
+        return 'relguard %s rejected %s' % (getattr(getattr(rel_guard, 'test', rel_guard), '__name__', rel_guard),
+                                           ', '.join('%s=%s' % (name, _value_repr(values[name])) for name in names))
+    return None
+
+class MultiFunc():
+    """
+    Class capable of function call dispatch based on call arguments.
+    """
+    def __init__(self):
+        self.clauses = {} # seperate tuples for different arities. Replaced, never changed, so reading needs no lock.
+        self.__name__ = None
+        self._selectors = {} # arity -> function returning body of the clause matching args, see `_selector`
+        self._compiled = False
+        self._lock = threading.Lock() # serialises changes of clauses
+        self._stats = {} # arity -> counters, see `stats`
+        self._collect_stats = False
+        self._adaptive = False
+        self._memo = None # `_Memo` if results are cached, see `enable_memoize`
+        self._decision_cache_size = None # see `enable_decision_cache`
+        self._tail_calls = False # see `enable_tail_calls`
+        self._plain = True # False if results are memoized or tail calls made, so calls go through `_run`
+        with _guard_mode_lock:
+            _multi_funcs.add(self)
+
+    def __call__(self, *args, **kwargs):
+        """
+        Dispatch. Note that different arities are dispatched separately and independently.
+        """
+        if not self._plain:
+            memo = self._memo
+            return memo.call(self, args, kwargs) if memo is not None else self._run(args, kwargs)
+
+        # same as `_dispatch`, inlined to save a call
+        arity = len(args) + len(kwargs)
+        selectors = self._selectors # read before clauses, see `append`
+        try:
+            select = selectors[arity]
+        except KeyError:
+            select = selectors[arity] = self._selector(arity)
+
+        body = select(args, kwargs)
+        if body is None: # no hit, raise
+            raise self._no_match(args, kwargs)
+        return body(*args, **kwargs) # call first matching function clause
+
+    def _run(self, args, kwargs):
+        "Calls the first clause matching arguments, and then tail calls it returns, if they're enabled."
+        result = self._dispatch(args, kwargs)
+        if self._tail_calls and isinstance(result, TailCall):
+            return _trampoline(result)
+        return result
+
+    def _dispatch(self, args, kwargs):
+        "Calls the first clause matching arguments, bypassing cached results."
+        arity = len(args) + len(kwargs)
+        selectors = self._selectors # read before clauses, see `append`
+        try:
+            select = selectors[arity]
+        except KeyError:
+            select = selectors[arity] = self._selector(arity)
+
+        body = select(args, kwargs)
+        if body is None: # no hit, raise
+            raise self._no_match(args, kwargs)
+        return body(*args, **kwargs) # call first matching function clause
+
+    def _no_match(self, args, kwargs):
+        "Returns MatchError for a call with given arguments. Nothing is formatted unless it's `explain`ed."
+        error = MatchError("No match for given argument values")
+        error.func = self
+        error.call_args = args
+        error.call_kwargs = kwargs
+        return error
+
+    def explain(self, *args, **kwargs):
+        """
+        Returns text telling, for each clause of the call's arity in order, which argument's guard (and which part of
+        it) or relguard rejects given arguments, up to the clause that matches them. Guards are checked again, one by
+        one, so it's slow; dispatch itself doesn't collect any of it.
+        """
+        arity = len(args) + len(kwargs)
+        clauses = self.clauses.get(arity, ())
+        call = ', '.join([_value_repr(arg) for arg in args] +
+                         ['%s=%s' % (name, _value_repr(value)) for name, value in sorted(kwargs.items())])
+        lines = ['%s(%s): %i clause(s) of arity %i' % (self.__name__, call, len(clauses), arity)]
+        for clause in clauses:
+            reason = _clause_rejection(clause, args, kwargs)
+            lines.append('  line %s: %s' % (_clause_line(clause), 'matches' if reason is None else reason))
+            if reason is None:
+                break
+        else:
+            lines.append('  no clause matches')
+        return '\n'.join(lines)
+
+    def _selector(self, arity):
+        """
+        Returns function taking `(args, kwargs)` and returning body of the first clause of given arity that matches
+        them, or None. It's built from current clauses and dropped as soon as a clause is appended.
+
+        If any clause of the arity is a coroutine function or has async guards, all calls with that arity return
+        a coroutine, see `_AsyncPlan`. Otherwise, it calls hooks of dispatch events if they have callbacks, see
+        `add_hook`.
+        """
+        clauses = self.clauses.get(arity, ())
+        if _has_async(clauses):
+            return _AsyncPlan(clauses, self._no_match).select
+        if self._collect_stats:
+            select = _StatsPlan(clauses, arity, self._stats.setdefault(arity, {'misses': 0, 'clauses': []})).select
+        else:
+            if self._adaptive:
+                select = _AdaptivePlan(clauses, arity).select
+            else:
+                plan = _Plan(clauses, arity)
+                tree = self._compiled and not _hooked(_guard_events) # tree doesn't call matchers, which call hooks
+                select = _DecisionTree(clauses, arity, plan).select if tree else plan.select
+            if self._decision_cache_size and not any(map(_checks_identity, clauses)):
+                select = _DecisionCache(select, self._decision_cache_size).select
+        if _hooked(_dispatch_events):
+            return _HookedPlan(self, clauses, select).select
+        return select
+
+    def compile(self):
+        """
+        Compiles clauses of every arity into a decision tree, which checks each distinct guard at most once per call.
+        Clauses appended later are compiled on the first call after. Guards have to be free of side effects.
+        Returns self.
+        """
+        with self._lock:
+            self._compiled = True
+            self._selectors = dict((arity, self._selector(arity)) for arity in self.clauses)
+        return self
+
+    def enable_adaptive(self, enabled=True):
+        """
+        Turns adaptive clause order on or off. When on, consecutive clauses which provably can't match the same
+        arguments are tried starting from the one that matched most often so far, see `_AdaptivePlan`. Calls give
+        the same results either way. Adaptive order is used instead of decision tree (see `compile`).
+        """
+        with self._lock:
+            self._adaptive = enabled
+            self._selectors = {}
+
+    def enable_stats(self, enabled=True):
+        """
+        Turns collecting statistics on or off, see `stats`. Calls are slower while they're being collected (and
+        clauses are never compiled into a decision tree), but not at all once it's turned off.
+        """
+        with self._lock:
+            self._collect_stats = enabled
+            self._selectors = {}
+
+    def stats(self):
+        """
+        Returns statistics collected since they were enabled or reset, as a dict: arity -> dict with 'misses' (number
+        of calls that raised MatchError) and 'clauses': list of dicts for each clause, in order, with
+            'line': first line of clause's code,
+            'tried': how many times its guards were checked,
+            'matched': how many times they passed,
+            'fell_through': how many times they didn't, so next clauses were tried,
+            'guard_time': total time spent on checking its guards, in seconds,
+            'body_time': total time spent on running it, in seconds.
+        Clauses skipped thanks to indexes (see `_Plan`) are not tried. Async clauses are not counted.
+        """
+        return dict((arity, {
+            'misses': stats['misses'],
+            'clauses': [{'line': counter.line, 'tried': counter.tried, 'matched': counter.matched,
+                         'fell_through': counter.tried - counter.matched, 'guard_time': counter.guard_time,
+                         'body_time': counter.body_time} for counter in stats['clauses']],
+        }) for arity, stats in self._stats.items())
+
+    def reset_stats(self):
+        "Zeroes all counters of `stats`."
+        with self._lock:
+            self._stats = {}
+            self._selectors = {}
+
+    def enable_decision_cache(self, enabled=True, maxsize=_decision_cache_size):
+        """
+        Turns caching of clause choice on or off. When on, the clause chosen for each tuple of (hashable) arguments
+        is remembered, so that calls with equal arguments of the same types run it without checking any guards.
+        Clauses are still run every time, so they may have side effects, but guards have to be pure: ones that read
+        external state would pass or fail as they did the first time. At most `maxsize` tuples are remembered, then
+        the cache starts over. It's also emptied whenever a clause is appended. Calls with iterator arguments aren't
+        cached, and neither are arities with clauses checking identity of arguments (`Is`, `Isnot`). Returns self.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize has to be positive")
+        with self._lock:
+            self._decision_cache_size = maxsize if enabled else None
+            self._selectors = {}
+        return self
+
+    def enable_memoize(self, enabled=True, maxsize=128):
+        """
+        Turns caching of results on or off. Only for pure functions: a call with the same (hashable) arguments
+        returns cached result of the first one, without checking guards or running any clause. At most `maxsize`
+        least recently used results are kept (all of them if None). Cache is emptied whenever a clause is appended.
+        Calls with unhashable or iterator arguments are dispatched as usual. Returns self.
+        """
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("maxsize has to be positive or None")
+        with self._lock:
+            self._memo = _Memo(maxsize) if enabled else None
+            self._plain = self._memo is None and not self._tail_calls
+        return self
+
+    def enable_tail_calls(self, enabled=True):
+        """
+        Turns tail calls on or off. When on, a `TailCall` returned by a clause is made by a loop in this MultiFunc,
+        and so are tail calls returned by that call, until one returns something else: that's the result. Stack
+        depth stays the same however many calls are made this way, and clauses of MultiFuncs are called directly,
+        without `__call__` or the wrapper of `guard` (which only checks guards already checked by dispatch).
+        Returns self.
+        """
+        with self._lock:
+            self._tail_calls = enabled
+            self._plain = self._memo is None and not self._tail_calls
+        return self
+
+    def cache_info(self):
+        """
+        Returns dict with counters of `enable_memoize` cache: 'hits', 'misses', 'unhashable' (calls that couldn't be
+        cached), 'maxsize' and 'size' (number of cached results), or None if caching is off.
+        """
+        memo = self._memo
+        return memo.info() if memo is not None else None
+
+    def cache_clear(self):
+        "Drops all results cached by `enable_memoize`, keeping counters."
+        memo = self._memo
+        if memo is not None:
+            memo.clear()
+
+    def batch(self, *columns):
+        """
+        Calls function on each row of `columns` (NumPy arrays or iterables, one for each positional argument, or a
+        single NumPy structured array with a field for each) and returns NumPy array of results, in row order.
+
+        Clauses are matched against whole columns with `GuardFunc.mask`. Then each clause is called once for each row
+        it matched, or, if it's `vectorized`, just once with sub-arrays of these rows. Requires NumPy.
+        """
+        import numpy
+        if len(columns) == 1 and getattr(getattr(columns[0], 'dtype', None), 'names', None):
+            columns = tuple(columns[0][name] for name in columns[0].dtype.names)
+        columns = tuple(_as_array(numpy, column) for column in columns)
+        if not columns:
+            raise ValueError("At least one column is required")
+        if any(column.ndim != 1 or len(column) != len(columns[0]) for column in columns):
+            raise ValueError("Columns must be one-dimensional and of equal length")
+        if _has_async(self.clauses.get(len(columns), ())):
+            raise TypeError("Async clauses can't be called in batch")
+
+        undecided = numpy.arange(len(columns[0]))
+        groups = []
+        for clause in self.clauses.get(len(columns), ()):
+            if not len(undecided):
+                break
+            rows = _clause_rows(numpy, clause, columns, undecided)
+            if len(rows):
+                groups.append((clause, rows))
+                undecided = numpy.setdiff1d(undecided, rows, assume_unique=True)
+        if len(undecided):
+            raise MatchError("No match for given argument values in row %d" % undecided[0])
+
+        parts = []
+        for clause, rows in groups:
+            body = _clause_parts(clause)[1]
+            if getattr(clause, '__vectorized__', False):
+                values = numpy.asarray(body(*[column[rows] for column in columns]))
+                if values.shape != rows.shape:
+                    raise ValueError("Vectorized clause of %s() returned %s results for %i rows"
+                                     % (self.__name__, values.shape, len(rows)))
+            else:
+                values = numpy.empty(len(rows), dtype=object)
+                for i, row in enumerate(zip(*[column[rows].tolist() for column in columns])):
+                    values[i] = body(*row)
+            parts.append((rows, values))
+
+        try:
+            dtype = numpy.result_type(*[values for rows, values in parts]) if parts else object
+        except TypeError: # no common type
+            dtype = object
+        results = numpy.empty(len(columns[0]), dtype=dtype)
+        for rows, values in parts:
+            results[rows] = values
+        return results
+
+    def append(self, arity, clause):
+        """
+        Append clause to `self.clauses` under given `arity`.
+
+        Clauses are copied on write: new clauses dict is published first, then an empty dict of selectors, so calls
+        running in other threads meanwhile see either the old clauses or the new ones, and never cache a selector
+        built from old clauses where new calls would find it.
+        """
+        with self._lock:
+            if self.clauses.get(arity, False) and hasattr(self.clauses[arity][-1], '__catchall__'):
+                raise WontMatchError("Function clause defined after a catch-all clause")
+
+            clauses = dict(self.clauses)
+            clauses[arity] = clauses.get(arity, ()) + (clause,)
+            self.clauses = clauses
+            self._selectors = {}
+            if self._memo is not None:
+                self._memo.clear()
+
+            if not self.__name__:
+                self.__name__ = clause.__name__
+                self.__module__ = clause.__module__
+                self.__qualname__ = getattr(clause, '__qualname__', clause.__name__)
+
+    def __reduce__(self):
+        "MultiFunc is pickled by reference to `function_refs`, so the process unpickling it has to import its module."
+        qualname = getattr(self, '__qualname__', None)
+        if function_refs.get(self.__module__, {}).get(qualname) is not self or '<locals>' in qualname:
+            raise TypeError("Can't pickle %r: it's not defined at module level" % self)
+        return (_registered, (self.__module__, self.__qualname__))
+
+    def map(self, iterable, processes=None, chunksize=None):
+        """
+        Calls function on each item of iterable in a pool of `processes` worker processes (one per CPU by default)
+        and returns list of results. Items are sent to workers in chunks of `chunksize`. Function has to be defined
+        at module level, so that workers can import it.
+        """
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(self, iterable, chunksize)
+        finally:
+            pool.terminate()
+
+
+_registry_lock = threading.Lock() # guards function_refs, so that concurrent `case` can't create two MultiFuncs
+function_refs = defaultdict(lambda: defaultdict(MultiFunc)) # needed for case to track multi-headed functions.
+    # module name -> fun (qual)name -> MultiFunc object
+
+def _registered(module, qualname):
+    "Returns MultiFunc registered under given name, importing its module first. Used for unpickling."
+    if qualname not in function_refs.get(module, {}):
+        __import__(module)
+    if qualname not in function_refs.get(module, {}):
+        raise AttributeError("Can't find function %s in %s" % (qualname, module))
+    return function_refs[module][qualname]
+
+def case(*dargs, **dkwargs):
+    """
+    Creates MultiFunc object or appends function clauses to an existing one.
+    """
+
+    def decorator(decoratee):
+        "Actual decorator."
+
+        # get arg_spec
+        try:
+            arg_spec = _getfullargspec_p(decoratee.__guarded__)
+        except AttributeError:
+            arg_spec = _getfullargspec_p(decoratee)
+
+        # different arities, seperate dispatch lists, so we need to count args
+        clause_arity = len(arg_spec.args)
+
+        # what guard should we wrap args with
+        if hasattr(decoratee, '__dispatch__'): # called by dispatch decorator
+            grd_wrap = isoftype
+        else:
+            grd_wrap = eq
+
+        # only positional and positional_or_kw args allowed
+        if arg_spec.varargs or arg_spec.keywords:
+            raise ValueError("Functions with varying arguments unsupported")
+        if getattr(arg_spec, 'kwonlyargs', False):
+            raise ValueError("Functions with keyword-only arguments unsupported")
+
+        # read defaults
+        if arg_spec.defaults is not None:
+            arg_defaults = dict(
+                    zip(
+                        arg_spec.args[-len(arg_spec.defaults):],
+                        arg_spec.defaults
+                    )
+                )
+        else:
+            arg_defaults = dict()
+
+        # parse dargs'n'dkwargs
+        if (dargs and dargs[0] is not decoratee) or dkwargs:
+            if arg_defaults:
+                raise ValueError("Default args are not allowed when pattern is specified as decorator arguments")
+
+            # check if correct (names and count)
+            for dkey in dkwargs:
+                if dkey not in arg_spec.args:
+                    raise ValueError("Function %s() has no argument '%s'" % (decoratee.__name__, dkey))
+            if len(dargs) > clause_arity:
+                raise ValueError("Pattern must have at most %i values, found %i" % (clause_arity, len(dargs)))
+
+            match_vals = dict(zip(arg_spec.args[:len(dargs)], dargs))
+            match_vals.update(dkwargs)
+        else: # direct decorator or with empty args:
+            match_vals = arg_defaults or dict() # will be dict() if arg_defaults is None
+
+        # parameters for captured values are filled by guard, their defaults are no patterns
+        captured = set(name for match in match_vals.values() for name, path in _captures(match))
+        match_vals = dict((arg_name, match) for arg_name, match in match_vals.items() if arg_name not in captured)
+
+        # set guards on decoratee
+        if not match_vals and not hasattr(decoratee, '__guarded__'): # this is a catch-all! no need for guarding this clause
+            decoratee.__catchall__ = True
+        elif hasattr(decoratee, '__guarded__'): # decoratee is already guarded; extend guards
+            if captured:
+                raise ValueError("Values can be captured by patterns of case only if the clause has no guard yet")
+            for arg_name, match in match_vals.items():
+                if match is _: # `_` and guard is just the guard
+                    continue
+                if not isinstance(match, GuardFunc): # guards (and patterns) are used as they are
+                    match = grd_wrap(match) # eq or isoftype
+                try:
+                    decoratee._argument_guards[arg_name] = match & decoratee._argument_guards[arg_name]
+                except KeyError:
+                    decoratee._argument_guards[arg_name] = match
+        else:
+            _guards = match_vals.copy()
+            _guards.update({k: grd_wrap(v) for k, v in match_vals.items() # guards (and patterns) are used as they are
+                            if v is not _ and not isinstance(v, GuardFunc)})
+            decoratee = guard(**_guards)(decoratee)
+        clause_arity -= len(getattr(decoratee, '_captures', ())) # filled in by guard, not passed to MultiFunc
+
+        # add to function_refs
+        try:
+            decoratee_name = decoratee.__qualname__ # py>=3.3
+        except AttributeError:
+            decoratee_name = decoratee.__name__
+
+        with _registry_lock:
+            multi_func = function_refs[decoratee.__module__][decoratee_name]
+        multi_func.append(clause_arity, decoratee)
+        if hasattr(decoratee, '__memoized__'):
+            memo = multi_func._memo
+            if memo is None or memo.maxsize != decoratee.__memoized__:
+                multi_func.enable_memoize(maxsize=decoratee.__memoized__)
+        if getattr(decoratee, '__tail_calls__', False) and not multi_func._tail_calls:
+            multi_func.enable_tail_calls()
+
+        # return MultiFunc object
+        return multi_func
+
+    # decide whether initialise decorator
+    if (len(dkwargs) == 0 and len(dargs) == 1 and callable(dargs[0])
+            and not isinstance(dargs[0], six.class_types + (GuardFunc,))):
+        return decorator(dargs[0])
+    else:
+        return decorator
+
+def vectorized(decoratee):
+    """
+    Marks function clause as taking whole columns of arguments in `MultiFunc.batch`. Put it below `case` and `guard`.
+    """
+    decoratee.__vectorized__ = True
+    return decoratee
+
+def memoized(maxsize=128):
+    """
+    Declares function pure, so that its results are cached, see `MultiFunc.enable_memoize`. Put it below `case` or
+    `dispatch` of any clause, as `@memoized` or `@memoized(maxsize)`.
+    """
+    if callable(maxsize): # used without arguments
+        return memoized()(maxsize)
+
+    def decorator(decoratee):
+        "Actual decorator."
+        decoratee.__memoized__ = maxsize
+        return decoratee
+    return decorator
+
+def tail_calls(decoratee):
+    """
+    Lets function make `TailCall`s, see `MultiFunc.enable_tail_calls`. Put it below `case` or `dispatch` of any
+    clause.
+    """
+    decoratee.__tail_calls__ = True
+    return decoratee
+
+def dispatch(*dargs, **dkwargs):
+    """
+    Like `case`, but dispatch happens on type instead of values.
+    """
+
+    def direct(decoratee):
+        decoratee.__dispatch__ = True # this will intruct case to wrap args in isoftype.
+        return case(decoratee)
+
+    def indirect(decoratee):
+        decoratee.__dispatch__ = True
+        return case(*dargs, **dkwargs)(decoratee)
+
+    if (len(dkwargs) == 0 and len(dargs) == 1 and callable(dargs[0])
+            and not isinstance(dargs[0], six.class_types + (GuardFunc,))):
+        return direct(dargs[0])
+    else:
+        return indirect
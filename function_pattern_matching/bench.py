@@ -0,0 +1,353 @@
+"""
+Benchmarks of guarded calls, dispatch and decoration, along with plain Python equivalents of them.
+
+Usage: python -m function_pattern_matching.bench [-h] [--json] [--quick] [--compare BASELINE] [group ...]
+
+Every result is time of a single operation in seconds (best of several repeats). Call benchmarks time a call made
+from a lambda, so a plain function call is listed for reference. With `--json` results are printed as JSON, which can
+be saved and later passed to `--compare`; then exit status is 1 if anything got slower than `--threshold` allows.
+"""
+from __future__ import division, print_function
+import argparse
+import functools
+import itertools
+import json
+import platform
+import sys
+import threading
+import time
+import timeit
+from collections import OrderedDict
+import function_pattern_matching as fpm
+
+_groups = OrderedDict() # group name -> benchmark function
+_default_groups = ('guard', 'relguard', 'case', 'dispatch', 'decorate') # 'threads' takes long and is run on demand
+_modules = itertools.count()
+
+def benchmark(group):
+    """
+    Registers a benchmark function under a group name. It takes options and yields `(name, params, operation)`,
+    where operation is a callable timed with no arguments, or yields `(name, params, seconds)` if it times itself.
+    """
+    def decorator(fun):
+        _groups[group] = fun
+        return fun
+    return decorator
+
+def _load(source, **namespace):
+    """
+    Executes source in a fresh module namespace and returns it, so generated functions get their own name in
+    `fpm.function_refs`.
+    """
+    namespace.update(__name__='_fpm_bench_%i' % next(_modules), fpm=fpm, functools=functools)
+    exec(compile(source, '<%s>' % namespace['__name__'], 'exec'), namespace)
+    return namespace
+
+def _measure(operation, min_time, repeat):
+    "Returns `(best, median, number)`, time of a single call of `operation`, and how many calls each repeat made."
+    timer = timeit.Timer(operation)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = sorted([elapsed] + timer.repeat(repeat - 1, number)) if repeat > 1 else [elapsed]
+    return times[0] / number, times[len(times) // 2] / number, number
+
+_positions = ('first', 'middle', 'last')
+
+def _hit(position, clauses):
+    "Index of clause matched at given position."
+    return {'first': 0, 'middle': clauses // 2, 'last': clauses - 1}[position]
+
+@benchmark('guard')
+def guard_benchmarks(options):
+    "Overhead of guarded call over plain one, by kind of guards and guard mode."
+    ns = _load('''
+def plain(a, b, c):
+    return a
+
+@fpm.makeguard
+def positive(inp):
+    return inp > 0
+
+@fpm.guard(fpm.gt(0))
+def one(a, b, c):
+    return a
+
+@fpm.guard(fpm.isoftype(int) & fpm.ge(0) & fpm.lt(100), fpm.In(['x', 'y']), fpm.Isnot(None))
+def three(a, b, c):
+    return a
+
+@fpm.guard(positive)
+def custom(a, b, c):
+    return a
+
+@fpm.guard(fpm.gt(0))
+def off(a, b, c):
+    return a
+
+@fpm.guard(fpm.gt(0))
+def sampled(a, b, c):
+    return a
+''')
+    fpm.set_guard_mode('off', func=ns['off'])
+    fpm.set_guard_mode('sample', func=ns['sampled'])
+    for name in ('plain', 'one', 'three', 'custom', 'off', 'sampled'):
+        fun = ns[name]
+        yield name, {}, lambda: fun(1, 'x', 2)
+
+@benchmark('relguard')
+def relguard_benchmarks(options):
+    "Cost of relguards, and of calling guarded function with keyword arguments instead of positional ones."
+    ns = _load('''
+def plain(a, b, c=0):
+    return a
+
+@fpm.guard(fpm.gt(0))
+def guarded(a, b, c=0):
+    return a
+
+@fpm.rguard(lambda a, b: a < b)
+def related(a, b, c=0):
+    return a
+
+@fpm.rguard(lambda a, b: a < b, a=fpm.gt(0), b=fpm.isoftype(int))
+def both(a, b, c=0):
+    return a
+''')
+    for name in ('plain', 'guarded', 'related', 'both'):
+        fun = ns[name]
+        yield name, {'call': 'positional'}, lambda: fun(1, 2)
+        yield name, {'call': 'keyword'}, lambda: fun(a=1, b=2)
+
+def _case_source(kind, clauses):
+    "Source of function `f(x)` of given number of clauses, where x picks clause number x."
+    if kind == 'values':
+        return ''.join('@fpm.case\ndef f(x=%i):\n    return %i\n\n' % (i, i) for i in range(clauses))
+    if kind == 'guards':
+        return ''.join('@fpm.case\n@fpm.guard(fpm.ge(%i) & fpm.lt(%i))\ndef f(x):\n    return %i\n\n' % (i, i + 1, i)
+                       for i in range(clauses))
+    if kind == 'if_chain':
+        return 'def f(x):\n%s    raise ValueError(x)\n' % ''.join(
+                '    %s x == %i:\n        return %i\n' % ('elif' if i else 'if', i, i) for i in range(clauses))
+    raise ValueError(kind)
+
+@benchmark('case')
+def case_benchmarks(options):
+    "MultiFunc dispatch by clause count and position of the matching clause, against an if chain."
+    for clauses in options.clauses:
+        for kind in ('values', 'values_compiled', 'guards', 'guards_compiled', 'guards_cached', 'if_chain'):
+            fun = _load(_case_source(kind.replace('_compiled', '').replace('_cached', ''), clauses))['f']
+            if kind.endswith('_compiled'):
+                fun.compile()
+            elif kind.endswith('_cached'):
+                fun.enable_decision_cache()
+            for position in _positions:
+                x = _hit(position, clauses)
+                yield kind, {'clauses': clauses, 'position': position}, lambda: fun(x)
+
+def _dispatch_source(kind, clauses):
+    "Source of classes T0, T1, ... and function `f(x)` returning number of x's class (S is a subclass of the last)."
+    classes = ''.join('class T%i(object):\n    pass\n\n' % i for i in range(clauses))
+    classes += 'class S(T%i):\n    pass\n\n' % (clauses - 1)
+    if kind == 'dispatch':
+        return classes + ''.join('@fpm.dispatch\ndef f(x=T%i):\n    return %i\n\n' % (i, i) for i in range(clauses))
+    if kind == 'singledispatch':
+        return classes + '@functools.singledispatch\ndef f(x):\n    raise TypeError(x)\n\n' + ''.join(
+                'f.register(T%i)(lambda x: %i)\n' % (i, i) for i in range(clauses))
+    if kind == 'if_chain':
+        return classes + 'def f(x):\n%s    raise TypeError(x)\n' % ''.join(
+                '    %s isinstance(x, T%i):\n        return %i\n' % ('elif' if i else 'if', i, i)
+                for i in range(clauses))
+    raise ValueError(kind)
+
+@benchmark('dispatch')
+def dispatch_benchmarks(options):
+    "Type routing of `dispatch` against functools.singledispatch and an isinstance chain."
+    kinds = ('dispatch', 'singledispatch', 'if_chain') if hasattr(functools, 'singledispatch') else \
+            ('dispatch', 'if_chain')
+    for clauses in options.clauses:
+        for kind in kinds:
+            ns = _load(_dispatch_source(kind, clauses))
+            fun = ns['f']
+            for position in _positions + ('subclass',):
+                if position == 'subclass':
+                    x = ns['S']()
+                else:
+                    x = ns['T%i' % _hit(position, clauses)]()
+                yield kind, {'clauses': clauses, 'position': position}, lambda: fun(x)
+
+@benchmark('decorate')
+def decorate_benchmarks(options):
+    "Time to import a module defining many guarded functions or clauses (and to call the multi-claused one once)."
+    functions = options.clauses[-1]
+    sources = {
+        'guard': ''.join('@fpm.guard(fpm.isoftype(int) & fpm.ge(0), b=fpm.ne(%i))\ndef f%i(a, b):\n    return a\n\n'
+                         % (i, i) for i in range(functions)),
+        'case': _case_source('values', functions) + 'f(0)\n',
+        'dispatch': _dispatch_source('dispatch', functions) + 'f(T0())\n',
+    }
+    for kind in ('guard', 'case', 'dispatch'):
+        code = compile(sources[kind], '<decorate %s>' % kind, 'exec')
+        def load(code=code):
+            name = '_fpm_bench_%i' % next(_modules)
+            exec(code, {'__name__': name, 'fpm': fpm})
+            fpm.function_refs.pop(name, None)
+        yield kind, {'functions': functions}, load
+
+@benchmark('threads')
+def thread_benchmarks(options):
+    """
+    Dispatch from growing number of threads, while another thread keeps appending clauses of a different arity. Calls
+    take no locks, so on free-threaded CPython (3.13t and later) time per call should drop with thread count; with the
+    GIL it stays flat.
+    """
+    route = _load('''
+@fpm.case
+def route(method='GET', path=fpm._):
+    return 'get'
+
+@fpm.case
+def route(method='POST', path=fpm._):
+    return 'post'
+
+@fpm.case
+@fpm.guard(fpm.isoftype(str), fpm.isoftype(str) & fpm.ne(''))
+def route(method, path):
+    return 'other'
+''')['route']
+    requests = [('GET', '/'), ('POST', '/a'), ('PUT', '/b'), ('DELETE', '/c')] * 25
+    calls = len(requests) * (200 if options.quick else 2000)
+
+    def worker(start):
+        start.wait()
+        for _ in range(calls // len(requests)):
+            for method, path in requests:
+                route(method, path)
+
+    def registrar(stop):
+        "Keeps registering clauses of another arity, so writers run concurrently with readers."
+        n = 0
+        while not stop.is_set():
+            n += 1
+            route.append(1, fpm.guard(fpm.eq(n))(lambda method: method))
+            time.sleep(0.001)
+
+    threads = 1
+    while threads <= options.threads:
+        start, stop = threading.Event(), threading.Event()
+        pool = [threading.Thread(target=worker, args=(start,)) for _ in range(threads)]
+        writer = threading.Thread(target=registrar, args=(stop,))
+        for thread in pool:
+            thread.start()
+        writer.start()
+        began = time.time()
+        start.set()
+        for thread in pool:
+            thread.join()
+        elapsed = time.time() - began
+        stop.set()
+        writer.join()
+        yield 'route', {'threads': threads}, elapsed / (threads * calls)
+        threads *= 2
+
+def run(groups=_default_groups, options=None, on_result=None):
+    """
+    Runs benchmarks of given groups and returns results: a dict with Python version and platform details, and
+    `results` list of dicts with `group`, `name`, `params`, `seconds` (best time of one operation), `median` and
+    `number` (of operations timed in a row). `on_result` is called with each result as soon as it's measured.
+    """
+    options = options or parse_args([])
+    results = []
+    for group in groups:
+        for name, params, operation in _groups[group](options):
+            if callable(operation):
+                best, median, number = _measure(operation, options.min_time, options.repeat)
+            else:
+                best = median = operation
+                number = 1
+            results.append({'group': group, 'name': name, 'params': params, 'seconds': best, 'median': median,
+                            'number': number})
+            if on_result is not None:
+                on_result(results[-1])
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'gil': getattr(sys, '_is_gil_enabled', lambda: True)(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+def _key(result):
+    return (result['group'], result['name'], tuple(sorted(result['params'].items())))
+
+def _format(result, baseline=None):
+    "One line of human-readable report."
+    seconds = result['seconds']
+    if seconds >= 1e-3:
+        shown = '%9.3f ms' % (seconds * 1e3)
+    elif seconds >= 1e-6:
+        shown = '%9.3f us' % (seconds * 1e6)
+    else:
+        shown = '%9.1f ns' % (seconds * 1e9)
+    line = '%-9s %-16s %-36s %s' % (result['group'], result['name'],
+                                     ' '.join('%s=%s' % item for item in sorted(result['params'].items())), shown)
+    if baseline is not None:
+        line += '  x%.2f' % (seconds / baseline['seconds'])
+    return line
+
+def compare(report, baseline, threshold):
+    "Returns results of report which are slower than the same ones in baseline by more than threshold (0.1 is 10%)."
+    old = dict((_key(result), result) for result in baseline['results'])
+    return [result for result in report['results']
+            if _key(result) in old and result['seconds'] > old[_key(result)]['seconds'] * (1 + threshold)]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m function_pattern_matching.bench',
+                                     description="Benchmarks of function_pattern_matching.")
+    parser.add_argument('groups', nargs='*', metavar='group',
+                        help="benchmark groups to run: %s (default: all but threads)" % ', '.join(_groups))
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--quick', action='store_true', help="time shorter, for a rough estimate")
+    parser.add_argument('--clauses', type=int, nargs='+', default=[4, 16, 64], metavar='N',
+                        help="clause counts of case and dispatch benchmarks (default: 4 16 64), the last one is also "
+                             "number of functions defined by decorate benchmarks")
+    parser.add_argument('--threads', type=int, default=8, metavar='N', help="max number of threads (default: 8)")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="slowdown against baseline reported as regression (default: 0.25, that is 25%%)")
+    options = parser.parse_args(argv)
+    for group in options.groups:
+        if group not in _groups:
+            parser.error("unknown benchmark group %r" % group)
+    options.min_time = 0.02 if options.quick else 0.2
+    options.repeat = 3 if options.quick else 5
+    return options
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    baseline = None
+    old = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)
+        old = dict((_key(result), result) for result in baseline['results'])
+
+    def show(result):
+        print(_format(result, old.get(_key(result))))
+        sys.stdout.flush()
+
+    report = run(options.groups or _default_groups, options, None if options.json else show)
+    if options.json:
+        print(json.dumps(report, indent=1, sort_keys=True))
+    if baseline is not None:
+        slower = compare(report, baseline, options.threshold)
+        for result in slower:
+            print("slower: " + _format(result), file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,6 +25,7 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules"
     ],
     keywords = "pattern matching guards",
-    py_modules = ['function_pattern_matching'],
-    install_requires = ['six']
+    packages = ['function_pattern_matching'],
+    install_requires = ['six'],
+    extras_require = {'numpy': ['numpy']}
 )
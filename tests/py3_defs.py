@@ -146,3 +146,37 @@ def ad3(
 
 def kwonly(a, b, *, c):
     return (a, b, c)
+
+# coroutines
+async def cached_lookup(inp):
+    return inp in {'alice', 'bob'}
+
+known_user = fpm.GuardFunc(cached_lookup)
+
+async def may_pass(a, b):
+    return a != b
+
+@fpm.guard(fpm.isoftype(str))
+async def greet(name):
+    return 'hi ' + name
+
+@fpm.guard(known_user & fpm.ne('bob'))
+def sync_with_async_guard(name):
+    return name
+
+@fpm.rguard(may_pass, a=fpm.gt(0))
+async def differ(a, b):
+    return (a, b)
+
+@fpm.case
+@fpm.guard(known_user)
+async def handle(user):
+    return 'known ' + user
+
+@fpm.case('root')
+def handle(user):
+    return 'root'
+
+@fpm.case
+async def handle(user):
+    return 'stranger'
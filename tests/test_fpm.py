@@ -3,13 +3,37 @@
 import sys, os
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import function_pattern_matching as fpm
+from function_pattern_matching import bench
 import unittest
+import abc
+import functools
+import pickle
+import six
+import json
+import tempfile
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try:
     from py3_defs import *
     py3 = True
 except SyntaxError:
     py3 = False
 
+@fpm.makeguard
+def is_even(inp):
+    return inp % 2 == 0
+
+@fpm.case
+@fpm.guard(is_even)
+def parity(n):
+    return 'even'
+
+@fpm.case
+def parity(n):
+    return 'odd'
+
 class DoGuardsWork(unittest.TestCase):
     def test_simple(self):
         "Test each basic guard"
@@ -154,6 +178,165 @@ class DoGuardsWork(unittest.TestCase):
         self.assertFalse(comp5(0))
         self.assertFalse(comp5([1,2,3]))
 
+    def test_expression_tree(self):
+        "Test structure of combined guards and optimisations made when compiling them"
+
+        calls = []
+        @fpm.makeguard
+        def logged(inp):
+            calls.append(inp)
+            return True
+
+        comp = (fpm.gt(0) & (fpm.isoftype(int) & fpm.lt(10))) | logged
+        self.assertEqual(comp.op, 'or')
+        self.assertEqual(comp.operands[0].op, 'and')
+        self.assertEqual(comp.operands[1].op, 'test')
+        self.assertEqual(repr(comp.operands[0]), "(gt(0) & (isoftype(%r) & lt(10)))" % int)
+
+        # short-circuits, so the right-hand side is evaluated only when needed
+        self.assertTrue(comp(5))
+        self.assertEqual(calls, [])
+        self.assertTrue(comp('a'))
+        self.assertEqual(calls, ['a'])
+
+        # _ is redundant in & and makes | always pass
+        self.assertEqual(fpm._simplify(fpm.eq(1) & fpm._).op, 'eq')
+        self.assertEqual(fpm._simplify(fpm.eq(1) | fpm._).op, '_')
+        self.assertTrue((fpm.eq(1) | fpm._)(2))
+        self.assertRaises(TypeError, lambda: fpm.eq(1) & (lambda inp: True))
+
+        # bounds folded to a chained comparison still fail quietly on unorderable types
+        self.assertEqual(fpm._simplify(fpm.ge(0) & fpm.eTrue & fpm.lt(1.5)).operands[0].op, 'between')
+        self.assertTrue((fpm.ge(0) & fpm.lt(1.5))(1))
+        self.assertFalse((fpm.ge(0) & fpm.lt(1.5))('a'))
+
+        # In with a tuple of hashable values looks up a set, but still works for unhashable input
+        intuple = fpm.In((1, 'a', None))
+        self.assertTrue(intuple('a'))
+        self.assertTrue(intuple(1.0))
+        self.assertFalse(intuple([]))
+        self.assertTrue(fpm.notIn((1, 'a'))({}))
+        self.assertTrue(fpm.In([frozenset()])(set()))
+
+        # lists may change after the guard is first used
+        allowed = ['a']
+        @fpm.guard(fpm.In(allowed))
+        def pick(item):
+            return item
+        @fpm.guard(fpm.notIn(allowed))
+        def other(item):
+            return item
+        self.assertEqual(pick('a'), 'a')
+        self.assertEqual(other('b'), 'b')
+        allowed.append('b')
+        self.assertEqual(pick('b'), 'b')
+        self.assertRaises(fpm.GuardError, other, 'b')
+
+    @unittest.skipIf(numpy is None, "NumPy not installed")
+    def test_mask(self):
+        "Test evaluating guards on arrays"
+
+        calls = []
+        @fpm.makeguard
+        def even(inp):
+            calls.append(inp)
+            return inp % 2 == 0
+
+        column = numpy.array([-2, 0, 3, 4, 15, 20])
+        comp = (fpm.ge(0) & fpm.lt(10) & even) | fpm.In([15, 16])
+        self.assertEqual(comp.mask(column).tolist(), [False, True, False, True, True, False])
+        self.assertEqual(calls, [0, 3, 4]) # custom guard only on elements where it decides
+        self.assertEqual(fpm.isoftype(float).mask(column.reshape(2, 3)).shape, (2, 3))
+
+        # isoftype checks dtype, elements are NumPy scalars
+        ints, floats = numpy.array([1, 2], dtype=numpy.int64), numpy.array([0.5])
+        for spec, values in ((numpy.int64, ints), (numpy.integer, ints), (numpy.number, ints), (int, ints),
+                             (bool, numpy.array([True])), (numpy.bool_, numpy.array([True])), (float, floats),
+                             (numpy.floating, floats), (numpy.integer, floats), (str, numpy.array(['a'])),
+                             ((int, numpy.integer), ints)):
+            self.assertEqual(fpm.isoftype(spec).mask(values).tolist(), [isinstance(value, spec) for value in values])
+        self.assertEqual(fpm.isoftype(numpy.integer).mask(ints).tolist(), [True, True])
+        self.assertEqual(fpm.isoftype(int).mask(ints).tolist(), [False, False])
+        is_int = fpm.makeguard(lambda inp: isinstance(inp, numpy.int64))
+        self.assertEqual(is_int.mask(ints).tolist(), [True, True]) # custom guards get NumPy scalars too
+
+        # same results as calling guard on each element, even when types are mixed
+        self.assertEqual(fpm.lt(2).mask(numpy.array(['a', 'b'])).tolist(), [False, False])
+        self.assertEqual(fpm.eq('a').mask(numpy.array(['a', 'b'])).tolist(), [True, False])
+        self.assertEqual(fpm.gt(0).mask([1, 'a', None, 2.5]).tolist(), [True, False, False, True])
+        self.assertEqual(fpm.isoftype(int).mask([1, '1', True]).tolist(), [True, False, True])
+
+    def test_each(self):
+        "Test element guards on containers and iterators"
+
+        @fpm.guard(fpm.each(fpm.isoftype(int) & fpm.ge(0)))
+        def total(values):
+            return sum(values)
+
+        self.assertEqual(total([1, 2, 3]), 6)
+        self.assertRaises(fpm.GuardError, total, [1, -1])
+        self.assertRaises(fpm.GuardError, total, 5)
+
+        consumed = []
+        def stream(*values):
+            for value in values:
+                consumed.append(value)
+                yield value
+        self.assertEqual(total(stream(1, 2)), 3)
+        self.assertRaises(fpm.GuardError, total, stream(1, -1, 2))
+        self.assertEqual(consumed, [1, 2, 1, -1]) # checked as consumed, up to the wrong element
+        self.assertTrue(fpm.each(fpm.gt(0))(iter([-1]))) # can't be checked without consuming it
+        self.assertRaises(TypeError, fpm.each, lambda inp: True)
+
+        # elsewhere than alone or under &, iterators would pass unchecked
+        def first(items):
+            pass
+        for grd in (fpm.each(fpm.gt(0)) | fpm.Is(None), ~fpm.each(fpm.gt(0)), fpm.each(fpm.gt(0)) ^ fpm.eTrue,
+                    fpm.seq(fpm.each(fpm.gt(0))), fpm.mapping(a=fpm.each(fpm.gt(0))),
+                    fpm.each(fpm.each(fpm.gt(0))), fpm.isiterable & (fpm.eTrue | fpm.each(fpm.gt(0)))):
+            self.assertRaises(ValueError, fpm.guard(grd), first)
+            self.assertRaises(ValueError, fpm.case(grd), first)
+        self.assertTrue(fpm.guard(fpm.isiterable & (fpm.eTrue & fpm.each(fpm.gt(0))))(first))
+
+        @fpm.guard(fpm.isiterable)
+        def guarded_first(items):
+            pass
+        self.assertRaises(ValueError, fpm.case(fpm.each(fpm.gt(0)) | fpm.eTrue), guarded_first)
+
+        @fpm.case
+        @fpm.guard(fpm.each(fpm.isoftype(str)))
+        def describe(items):
+            return ','.join(items)
+
+        @fpm.case
+        def describe(items):
+            return None
+
+        self.assertEqual(describe(['a', 'b']), 'a,b')
+        self.assertIs(describe(['a', 1]), None)
+        self.assertEqual(describe(iter(['a', 'b'])), 'a,b')
+        self.assertRaises(fpm.GuardError, describe, iter(['a', 1]))
+
+        if numpy is not None:
+            # elements of arrays are NumPy scalars, as if the array was iterated
+            self.assertRaises(fpm.GuardError, total, numpy.arange(4))
+            self.assertTrue(fpm.each(fpm.isoftype(numpy.integer) & fpm.ge(0))(numpy.arange(4)))
+            self.assertFalse(fpm.each(fpm.gt(0))(numpy.array([1, 0])))
+
+    def test_pickle(self):
+        "Test pickling guards by structure and decorated guards by name"
+
+        comp = pickle.loads(pickle.dumps((fpm.gt(0) & fpm.lt(10)) | fpm.In(['a']) | ~is_even))
+        self.assertEqual(repr(comp), "(((gt(0) & lt(10)) | In(['a'])) | ~is_even)")
+        self.assertTrue(comp(3))
+        self.assertFalse(comp(12))
+        self.assertIs(pickle.loads(pickle.dumps(fpm.isiterable)), fpm.isiterable)
+
+        used = fpm.gt(0)
+        used(1) # compiled test is not pickled
+        self.assertTrue(pickle.loads(pickle.dumps(used, 2))(1))
+        self.assertRaises(Exception, pickle.dumps, fpm.makeguard(lambda inp: True))
+
     def test_relation_guards(self):
         "Test relguard (relations between arguments)"
 
@@ -168,6 +351,23 @@ class DoGuardsWork(unittest.TestCase):
         self.assertFalse(rg2())
         self.assertEqual(rg2.__argnames__, set())
 
+        # only needed arguments are passed on, missing ones make relguard fail
+        rg3 = fpm.relguard(lambda c, a: a < c)
+        self.assertTrue(rg3(a=1, b=2, c=3, d=4))
+        self.assertFalse(rg3(a=1, c='x'))
+        self.assertFalse(rg3(a=1))
+
+        # missing arguments with defaults get them, like in guarded functions
+        rg4 = fpm.relguard(lambda a, c=3: a < c)
+        self.assertTrue(rg4(a=1))
+        self.assertFalse(rg4(a=1, c=0))
+
+        @fpm.guard(rg4)
+        def below(a, c=3):
+            return a
+        self.assertEqual(below(1), 1)
+        self.assertRaises(fpm.GuardError, below, 1, 0)
+
     def test_guarded_correctly_decargs(self):
         "Test every possible correct way of defining guards (Py2 & 3, no relguards)"
 
@@ -498,6 +698,160 @@ class DoGuardsWork(unittest.TestCase):
         self.assertRaises(fpm.GuardError, rwsk3ra, 9000, "x", 9000.1)
         self.assertRaises(fpm.GuardError, rwak3ra, 'x', 'y', 'x')
 
+    def test_guarded_wrapper(self):
+        "Test generated wrapper: varying args, defaults and changing guards after decoration"
+
+        @fpm.guard(fpm.relguard(lambda c, a: a < c), a=fpm.gt(0))
+        def wrapped(a, b=[], c=10, *args, **kwargs):
+            return (a, b, c, args, kwargs)
+
+        self.assertEqual(wrapped(1), (1, [], 10, (), {}))
+        self.assertEqual(wrapped(1, 2, 3, 4, d=5), (1, 2, 3, (4,), {'d': 5}))
+        self.assertIs(wrapped(1)[1], wrapped(2)[1]) # same default object, just like in the wrapped function
+        self.assertRaises(fpm.GuardError, wrapped, 0)
+        self.assertRaises(fpm.GuardError, wrapped, 1, c=1)
+        self.assertRaises(TypeError, wrapped)
+
+        wrapped._argument_guards['b'] = fpm.isoftype(list)
+        self.assertEqual(wrapped(1, [0]), (1, [0], 10, (), {}))
+        self.assertRaises(fpm.GuardError, wrapped, 1, 2)
+
+        # wrapper's own helpers can't be shadowed by arguments
+        @fpm.guard(fpm.eq(1))
+        def guarded(guarded, _fpm_decoratee=2, _fpm_GuardError=3):
+            return (guarded, _fpm_decoratee, _fpm_GuardError)
+
+        self.assertEqual(guarded(1), (1, 2, 3))
+        self.assertRaises(fpm.GuardError, guarded, 2)
+
+    def test_guarded_callables(self):
+        "Test guarding callables other than plain functions, and functions with positional-only parameters"
+        def add(a, b):
+            return a + b
+
+        class Double(object):
+            def __call__(self, x):
+                return 2 * x
+
+        self.assertEqual(fpm.guard(fpm.gt(0))(functools.partial(add, 1))(2), 3)
+        self.assertRaises(fpm.GuardError, fpm.guard(fpm.gt(0))(functools.partial(add, 1)), 0)
+        self.assertEqual(fpm.guard(fpm.gt(0))(Double())(4), 8)
+
+    @unittest.skipIf(sys.version_info < (3, 8), "No positional-only parameters")
+    def test_guarded_positional_only(self):
+        namespace = {}
+        exec("def f(a, b=2, /, *args, c=3):\n    return (a, b, args, c)", namespace)
+        guarded = fpm.guard(fpm.gt(0), fpm._)(namespace['f'])
+
+        self.assertEqual(guarded(1, 5, 6, c=7), (1, 5, (6,), 7))
+        self.assertRaises(TypeError, guarded, a=1, b=2)
+        self.assertRaises(fpm.GuardError, guarded, 0)
+
+    def test_guard_mode(self):
+        "Test switching guard checks off and sampling them, globally and per function"
+
+        @fpm.guard(fpm.gt(0))
+        def positive(a):
+            return a
+
+        @fpm.rguard(lambda a, b: a < b)
+        def ordered(a, b):
+            return (a, b)
+
+        @fpm.case
+        @fpm.guard(fpm.gt(0))
+        def sign_of(a):
+            return 1
+
+        @fpm.case
+        def sign_of(a):
+            return -1
+
+        reported = []
+        try:
+            fpm.set_guard_mode('off')
+            self.assertEqual(positive(-1), -1)
+            self.assertEqual(ordered(2, 1), (2, 1))
+            self.assertEqual(sign_of(-5), -1) # dispatch guards are always checked
+
+            fpm.set_guard_mode('on', func=positive)
+            self.assertRaises(fpm.GuardError, positive, -1)
+            self.assertEqual(ordered(2, 1), (2, 1))
+
+            fpm.set_guard_mode('sample', every=3, report=lambda func, err: reported.append(func), func=ordered)
+            self.assertEqual([ordered(2, 1) for i in range(7)], [(2, 1)] * 7)
+            self.assertEqual(reported, [ordered] * 3)
+
+            fpm.set_guard_mode(None, func=ordered) # follows global mode again
+            self.assertEqual(ordered(2, 1), (2, 1))
+            self.assertEqual(reported, [ordered] * 3)
+        finally:
+            fpm.set_guard_mode('on')
+        self.assertRaises(fpm.GuardError, ordered, 2, 1)
+        self.assertRaises(fpm.GuardError, positive, -1)
+        self.assertRaises(ValueError, fpm.set_guard_mode, 'maybe')
+        self.assertRaises(ValueError, fpm.set_guard_mode, 'on', func=len)
+
+        # captured values are only there once guards passed, so they're always checked
+        @fpm.guard(fpm.seq(fpm.bind('head'), rest=fpm.bind('tail')))
+        def split(items, head, tail):
+            return (head, tail)
+        for mode in ('sample', 'off'):
+            fpm.set_guard_mode(mode, every=1, func=split)
+            self.assertEqual(split([1, 2]), (1, [2]))
+            self.assertRaises(fpm.GuardError, split, [])
+            self.assertRaises(fpm.GuardError, split, {'a': 1})
+
+    def test_guard_order(self):
+        "Test that cheap guards are checked first, unless it could change the outcome"
+
+        calls = []
+        @fpm.makeguard(cost=100)
+        def expensive(inp):
+            calls.append(inp)
+            return inp.startswith('x') # AttributeError for non-strings
+
+        @fpm.makeguard
+        def is_str(inp):
+            return isinstance(inp, str)
+
+        self.assertEqual(expensive.cost, 100)
+        self.assertEqual(fpm._simplify(expensive & fpm.Is(None)).operands[1], expensive)
+        self.assertEqual(fpm._simplify(is_str & expensive & fpm.ne('')).operands[0].op, 'ne')
+        self.assertEqual(fpm._simplify(is_str & expensive & fpm.ne('')).operands[1:], (is_str, expensive))
+        self.assertEqual(pickle.loads(pickle.dumps(fpm.GuardFunc(len, cost=7))).cost, 7)
+
+        @fpm.guard(a=expensive, b=fpm.Is(None))
+        def cheap_second(a, b):
+            return a
+
+        self.assertRaises(fpm.GuardError, cheap_second, 1, 2) # expensive would raise AttributeError
+        self.assertEqual(calls, [])
+        self.assertEqual(cheap_second('xy', None), 'xy')
+        self.assertEqual(calls, ['xy'])
+
+        # custom guards keep their order, even if the second one is cheaper
+        @fpm.guard(a=is_str & expensive)
+        def custom(a):
+            return a
+        self.assertRaises(fpm.GuardError, custom, 1)
+
+        # observed rejection rates decide between guards of the same cost
+        @fpm.guard(a=fpm.gt(0), b=fpm.lt(0))
+        def tuned(a, b):
+            return a
+        fpm.tune_guards(tuned, calls=10)
+        self.assertIsNotNone(tuned._tuning)
+        for i in range(10):
+            self.assertRaises(fpm.GuardError, tuned, 1, 1)
+        self.assertIsNone(tuned._tuning)
+        self.assertEqual(tuned._rejection_rates, {'a': 0.0, 'b': 1.0})
+        with self.assertRaises(fpm.GuardError) as raised:
+            tuned(-1, 1)
+        self.assertIn("'b'", str(raised.exception)) # b is checked first now
+        self.assertEqual(tuned(1, -1), 1)
+        self.assertRaises(ValueError, fpm.tune_guards, len)
+
     def test_guarded_definition_errors_decargs(self):
         "Test syntactically correct but erroneous guard definitions"
 
@@ -590,6 +944,44 @@ class DoGuardsWork(unittest.TestCase):
             self.assertEqual(da_with_ann('x', [], 2), ('x', [], 2))
             self.assertIs(da_with_ann._argument_guards['c'], fpm._)
 
+    def test_deferred_validation(self):
+        "Test argspec cache, compiling guarded functions on first call and checking guard definitions later"
+
+        def decoratee(a, b=1, *args, **kwargs):
+            return (a, b)
+        arg_spec = fpm._getfullargspec_p(decoratee)
+        self.assertEqual((arg_spec.args, arg_spec.varargs, arg_spec.keywords, arg_spec.defaults),
+                         (('a', 'b'), 'args', 'kwargs', (1,)))
+        self.assertIn(decoratee.__code__, fpm._code_args)
+        self.assertEqual(fpm._getfullargspec_p(six.wraps(decoratee)(lambda *args: None)).args, ('a', 'b'))
+
+        guarded = fpm.guard(fpm.gt(0))(decoratee)
+        self.assertIs(guarded.__code__, fpm._first_call_code)
+        self.assertIs(guarded._matches.__code__, fpm._first_call_code)
+        self.assertEqual(guarded(1), (1, 1)) # defaults are taken over too
+        self.assertIsNot(guarded.__code__, fpm._first_call_code)
+        self.assertRaises(fpm.GuardError, guarded, 0)
+        self.assertIs(guarded._matches.__code__, fpm._first_call_code)
+
+        fpm.defer_validation = True
+        try:
+            bad = fpm.guard(a=zip)(decoratee)
+            self.assertRaises(ValueError, bad, 1)
+            self.assertRaises(ValueError, fpm.finalize)
+
+            @fpm.case
+            @fpm.guard(a=zip)
+            def bad_clauses(a):
+                return a
+
+            @fpm.case
+            def bad_clauses(a):
+                return a
+
+            self.assertRaises(ValueError, bad_clauses, 1)
+        finally:
+            fpm.defer_validation = False
+
 class IsDispatchCorrect(unittest.TestCase):
     def test_with_catchall(self):
         "Test function defined with catch all case"
@@ -698,6 +1090,91 @@ class IsDispatchCorrect(unittest.TestCase):
         self.assertEqual(fib(10), 55)
         self.assertEqual(fib(11), 89)
 
+    def test_value_index(self):
+        "Test dispatch of constant-value clauses interleaved with guarded ones"
+
+        class AlwaysEqual(object):
+            def __eq__(self, other):
+                return True
+            __hash__ = object.__hash__
+
+        for i in range(10):
+            @fpm.case(i, fpm._)
+            def opcode(code, payload):
+                return ('const', code)
+
+        @fpm.case
+        @fpm.guard(fpm.isoftype(str))
+        def opcode(code, payload):
+            return ('str', code)
+
+        @fpm.case
+        def opcode(code='x', payload=0):
+            return ('x0', code)
+
+        @fpm.case(fpm._, 'p')
+        def opcode(code, payload):
+            return ('p', code)
+
+        @fpm.case('y', fpm._)
+        def opcode(code, payload):
+            return ('y', code)
+
+        @fpm.case(10, 10)
+        def opcode(code, payload):
+            return ('ten', code)
+
+        self.assertEqual(opcode(3, {}), ('const', 3))
+        self.assertIsNotNone(opcode._selectors[2].__self__.runs[0][1]) # first run is indexed
+        self.assertEqual(opcode(3.0, []), ('const', 3.0))
+        self.assertEqual(opcode(True, None), ('const', True))
+        self.assertEqual(opcode('x', 0), ('str', 'x'))
+        self.assertEqual(opcode(11, 'p'), ('p', 11))
+        self.assertEqual(opcode('y', 1), ('str', 'y'))
+        self.assertEqual(opcode(10, 10), ('ten', 10))
+        self.assertEqual(opcode(10.0, 10), ('ten', 10.0))
+        self.assertRaises(fpm.MatchError, opcode, 10, 11)
+        self.assertRaises(fpm.MatchError, opcode, float('nan'), 0)
+        self.assertEqual(opcode(code=3, payload=None), ('const', 3))
+
+        # lookup can't be trusted for types with custom equality, so those are matched one by one
+        anything = AlwaysEqual()
+        self.assertEqual(opcode(anything, 0), ('const', anything))
+
+    def test_match_protocol(self):
+        "Test that clauses are matched without GuardError, and that errors from clause bodies are not swallowed"
+
+        @fpm.guard(fpm.gt(0))
+        def positive(n):
+            return n
+
+        self.assertIs(positive._matches(1), True)
+        self.assertIs(positive._matches(-1), False)
+        self.assertIs(positive._matches('x'), False)
+
+        calls = []
+        def logged(func):
+            @six.wraps(func)
+            def wrapper(*args):
+                calls.append(args)
+                return func(*args)
+            return wrapper
+
+        @fpm.case
+        def reciprocal(n=0):
+            return positive(n) # GuardError from the body is not a reason to try next clause
+
+        @fpm.case
+        @logged
+        @fpm.guard(fpm.isoftype(int))
+        def reciprocal(n):
+            return 1.0 / n
+
+        self.assertRaises(fpm.GuardError, reciprocal, 0)
+        self.assertEqual(reciprocal(2), 0.5)
+        self.assertEqual(calls, [(2,)]) # decorators between case and guard are not skipped
+        self.assertRaises(fpm.MatchError, reciprocal, 2.0)
+
     def test_bad_case_defs(self):
         "Syntactically correct, but erroneous multi-clause functions definitions."
 
@@ -751,5 +1228,764 @@ class IsDispatchCorrect(unittest.TestCase):
         self.assertEqual(dis('1', '2', '3'),    (3, '1', '2', '3'))
         self.assertRaises(fpm.MatchError, dis, '1', [], 0)
 
+    def test_dispatch_type_cache(self):
+        "Test dispatch on types cached per argument types"
+
+        @six.add_metaclass(abc.ABCMeta)
+        class Serializable(object):
+            pass
+
+        class Point(object):
+            pass
+
+        @fpm.dispatch(bool)
+        def dump(obj):
+            return 'bool'
+
+        @fpm.dispatch(int)
+        @fpm.guard(fpm.ge(0))
+        def dump(obj):
+            return 'natural'
+
+        @fpm.dispatch(int)
+        def dump(obj):
+            return 'int'
+
+        @fpm.dispatch(Serializable)
+        def dump(obj):
+            return 'serializable'
+
+        @fpm.dispatch((list, tuple))
+        def dump(obj):
+            return 'sequence'
+
+        self.assertIsInstance(fpm._Plan(dump.clauses[1], 1).runs[0][1], fpm._TypeIndex)
+        self.assertEqual(dump(True), 'bool')
+        self.assertEqual(dump(1), 'natural')
+        self.assertEqual(dump(-1), 'int') # same types, but value guard rejects
+        self.assertEqual(dump(()), 'sequence')
+        self.assertRaises(fpm.MatchError, dump, Point())
+
+        Serializable.register(Point) # invalidates cached types
+        self.assertEqual(dump(Point()), 'serializable')
+
+        @fpm.dispatch(object)
+        def dump(obj):
+            return 'object'
+
+        self.assertEqual(dump(1.5), 'object') # clause added after the first call is found, too
+
+        # proxies share their type, but isinstance goes by the class they report
+        class Proxy(object):
+            def __init__(self, wrapped):
+                self.wrapped = wrapped
+
+            @property
+            def __class__(self):
+                return type(self.wrapped)
+
+        @fpm.dispatch(bool)
+        def kind(obj):
+            return 'bool'
+
+        @fpm.dispatch(int)
+        def kind(obj):
+            return 'int'
+
+        @fpm.dispatch(str)
+        def kind(obj):
+            return 'str'
+
+        @fpm.dispatch((list, tuple))
+        def kind(obj):
+            return 'sequence'
+
+        self.assertIsInstance(fpm._Plan(kind.clauses[1], 1).runs[0][1], fpm._TypeIndex)
+        self.assertEqual(kind(Proxy(1)), 'int')
+        self.assertEqual(kind(Proxy('a')), 'str')
+        self.assertEqual(kind(Proxy([])), 'sequence')
+        self.assertEqual(kind('a'), 'str')
+
+    def test_decision_tree(self):
+        checked = []
+
+        @fpm.makeguard
+        def counted(inp):
+            checked.append(inp)
+            return isinstance(inp, int)
+
+        @fpm.case
+        @fpm.guard(counted & fpm.eq(0), fpm._)
+        def area(shape, size):
+            return 'point'
+
+        @fpm.case
+        @fpm.guard(counted & fpm.eq(1), fpm.gt(0))
+        def area(shape, size):
+            return 'segment'
+
+        @fpm.case
+        @fpm.guard(counted & fpm.eq(2), fpm.gt(0) & fpm.lt(10))
+        def area(shape, size):
+            return 'small square'
+
+        @fpm.case
+        @fpm.guard(counted, fpm.gt(0))
+        def area(shape, size):
+            return 'other'
+
+        self.assertIs(area.compile(), area)
+        self.assertEqual(area(2, 5), 'small square')
+        self.assertEqual(checked, [2]) # shared guard is checked once
+        self.assertEqual(area(0, 'x'), 'point')
+        self.assertEqual(area(2, 50), 'other')
+        self.assertRaises(fpm.MatchError, area, 1, -1)
+        self.assertRaises(fpm.MatchError, area, 'x', 5)
+        self.assertEqual(area(shape=1, size=1), 'segment') # keyword calls use clauses in order
+
+        @fpm.case
+        def area(shape, size):
+            return 'anything'
+
+        self.assertEqual(area('x', 5), 'anything') # recompiled after append
+
+    def test_patterns(self):
+        @fpm.case
+        def handle(msg=fpm.seq('ok', fpm.bind('value')), value=None):
+            return ('ok', value)
+
+        @fpm.case
+        @fpm.guard(fpm.seq('error', fpm.bind('reason', fpm.isoftype(str)), rest=fpm.bind('extra')))
+        def handle(msg, reason, extra):
+            return ('error', reason, extra)
+
+        @fpm.case(fpm.mapping(type='move', to=fpm.seq(fpm.bind('x'), fpm.bind('y'))))
+        def handle(msg, x, y):
+            return ('move', x, y)
+
+        @fpm.case(fpm.attrs(complex, imag=0, real=fpm.bind('real')))
+        def handle(msg, real):
+            return ('real', real)
+
+        @fpm.case
+        def handle(msg):
+            return 'other'
+
+        self.assertEqual(list(handle.clauses), [1]) # parameters for captured values don't count
+        for compiled in (False, True):
+            if compiled:
+                handle.compile()
+            self.assertEqual(handle(('ok', 5)), ('ok', 5))
+            self.assertEqual(handle(['error', 'bad', 1, 2]), ('error', 'bad', [1, 2]))
+            self.assertEqual(handle(('error', 'bad')), ('error', 'bad', ()))
+            self.assertEqual(handle(('error', 1)), 'other')
+            self.assertEqual(handle({'type': 'move', 'to': (1, 2), 'by': 'me'}), ('move', 1, 2))
+            self.assertEqual(handle({'type': 'move', 'to': (1, 2, 3)}), 'other')
+            self.assertEqual(handle(2 + 0j), ('real', 2))
+            self.assertEqual(handle('ok'), 'other')
+            self.assertEqual(handle(msg=('ok', 1)), ('ok', 1))
+
+        # type and length checks of clauses are shared in decision tree
+        tree = fpm._DecisionTree(handle.clauses[1], 1, None)
+        self.assertEqual(len([key for key in tree.tests if key[1] in ('isoftype', 'length')]), 5)
+
+        self.assertEqual(handle.clauses[1][1](('error', 'x', 1)), ('error', 'x', (1,)))
+        self.assertRaises(fpm.GuardError, handle.clauses[1][1], ('ok', 'x'))
+        self.assertTrue(fpm.seq(1, rest=fpm.seq(2))((1, 2)))
+        self.assertFalse(fpm.mapping({1: fpm._})({}))
+        self.assertEqual(pickle.loads(pickle.dumps(fpm.seq(1, fpm.bind('x'))))([1, 'a']), True)
+
+        def point(pos, x, y):
+            pass
+        self.assertRaises(ValueError, fpm.guard(fpm.seq(fpm.bind('x')) | fpm.eq(0)), point)
+        self.assertRaises(ValueError, fpm.guard(fpm.seq(fpm.bind('y'), fpm.bind('pos'))), point)
+        self.assertRaises(ValueError, fpm.guard(fpm.seq(fpm.bind('x'), fpm.bind('y')), fpm._, fpm.gt(0)), point)
+        self.assertRaises(ValueError, fpm.bind, '1x')
+        self.assertRaises(ValueError, fpm.bind, 'class')
+        self.assertRaises(ValueError, fpm.bind, 'a-b')
+
+        # attributes which aren't identifiers are got with getattr
+        class Record(object):
+            pass
+        record = Record()
+        setattr(record, 'a-b', 1)
+        self.assertTrue(fpm.attrs(**{'a-b': 1})(record))
+        self.assertFalse(fpm.attrs(**{'a-b': 2})(record))
+
+        @fpm.case
+        @fpm.guard(fpm.attrs(**{'a-b': fpm.bind('value')}))
+        def field(obj, value):
+            return value
+
+        @fpm.case
+        def field(obj):
+            return None
+        self.assertEqual(field(record), 1)
+        self.assertIsNone(field(Record()))
+        self.assertEqual(field.compile()(record), 1)
+
+    @unittest.skipIf(numpy is None, "NumPy not installed")
+    def test_batch(self):
+        rows = []
+
+        @fpm.case
+        def price(kind='free', qty=fpm._):
+            return 0
+
+        @fpm.case
+        @fpm.guard(fpm.In(['a', 'b']), fpm.gt(0))
+        @fpm.vectorized
+        def price(kind, qty):
+            rows.append(len(qty))
+            return qty * 10
+
+        @fpm.case
+        def price(kind, qty):
+            return -1
+
+        kinds = numpy.array(['a', 'free', 'b', 'c', 'a'])
+        qtys = numpy.array([1, 5, 2, 3, -1])
+        self.assertEqual(price.batch(kinds, qtys).tolist(), [10, 0, 20, -1, -1])
+        self.assertEqual(rows, [2]) # vectorized clause called once for all of its rows
+        self.assertEqual(price.batch(['free', 'a'], [1, 2]).tolist(), [0, 20])
+
+        records = numpy.array([('b', 3), ('x', 3)], dtype=[('kind', 'U4'), ('qty', int)])
+        self.assertEqual(price.batch(records).tolist(), [30, -1])
+        self.assertRaises(ValueError, price.batch, kinds, qtys[:2])
+
+        @fpm.case
+        def price(kind, qty, discount):
+            return 0
+        self.assertRaises(fpm.MatchError, price.batch, kinds)
+
+        # rows are matched as the Python values clauses get
+        @fpm.dispatch(int)
+        def twice(value):
+            return 2 * value
+
+        @fpm.dispatch(object)
+        def twice(value):
+            return None
+        self.assertEqual(twice.batch(numpy.array([1, 2])).tolist(), [2, 4])
+
+    def test_pickle_and_map(self):
+        self.assertIs(pickle.loads(pickle.dumps(parity)), parity)
+        self.assertEqual(parity.map(range(5), processes=2), ['even', 'odd', 'even', 'odd', 'even'])
+
+        @fpm.case
+        def local(n):
+            return n
+        self.assertRaises(Exception, pickle.dumps, local)
+
+    def test_adaptive(self):
+        @fpm.case
+        @fpm.guard(fpm.lt(0))
+        def bucket(n):
+            return 'negative'
+
+        @fpm.case
+        @fpm.guard(fpm.ge(0) & fpm.lt(10))
+        def bucket(n):
+            return 'small'
+
+        @fpm.case
+        @fpm.guard(fpm.ge(10))
+        def bucket(n):
+            return 'big'
+
+        @fpm.case
+        def bucket(n):
+            return 'other'
+
+        plan = fpm._AdaptivePlan(bucket.clauses[1], 1)
+        self.assertEqual([len(group.clauses) for group in plan.groups], [3, 1])
+        for _ in range(fpm._adapt_every):
+            plan.select((50,), {})
+        self.assertEqual(plan.groups[0].order, (2, 0, 1)) # hot clause is tried first now
+
+        bucket.enable_adaptive()
+        for _ in range(fpm._adapt_every):
+            self.assertEqual(bucket(50), 'big')
+        self.assertEqual(bucket(50), 'big')
+        self.assertEqual(bucket(-1), 'negative')
+        self.assertEqual(bucket(5), 'small')
+        self.assertEqual(bucket('x'), 'other')
+
+        # custom guards and relguards might have side effects or raise, so their clauses keep their places
+        tried = []
+
+        @fpm.makeguard(cost=0)
+        def logged(inp):
+            tried.append(inp)
+            return True
+
+        @fpm.case
+        @fpm.guard(fpm.lt(0) & logged)
+        def logged_bucket(n):
+            return 'negative'
+
+        @fpm.case
+        @fpm.guard(fpm.ge(10))
+        def logged_bucket(n):
+            return 'big'
+
+        @fpm.case
+        @fpm.rguard(lambda n: True, n=fpm.eq(5))
+        def logged_bucket(n):
+            return 'five'
+
+        @fpm.case
+        @fpm.guard(fpm.eq(6))
+        def logged_bucket(n):
+            return 'six'
+
+        groups = fpm._AdaptivePlan(logged_bucket.clauses[1], 1).groups
+        self.assertEqual([len(group.clauses) for group in groups], [1, 1, 1, 1])
+        logged_bucket.enable_adaptive()
+        for _ in range(fpm._adapt_every):
+            self.assertEqual(logged_bucket(-1), 'negative')
+        self.assertEqual(logged_bucket(6), 'six')
+        self.assertEqual(len(tried), fpm._adapt_every)
+
+        # can't prove that clauses are disjoint for any value, so order is kept
+        @fpm.case
+        @fpm.guard(fpm.eq(1))
+        def overlapping(n):
+            return 'one'
+
+        @fpm.case
+        @fpm.guard(fpm.isoftype(int))
+        def overlapping(n):
+            return 'int'
+
+        self.assertEqual(len(fpm._AdaptivePlan(overlapping.clauses[1], 1).groups), 2)
+
+    def test_stats(self):
+        @fpm.case
+        def sign(n=0):
+            return 0
+
+        @fpm.case
+        @fpm.guard(fpm.gt(0))
+        def sign(n):
+            return 1
+
+        sign(1) # selector without counters is already built
+        sign.enable_stats()
+        for n in (-1, 0, 1, 2):
+            try:
+                sign(n)
+            except fpm.MatchError:
+                pass
+
+        stats = sign.stats()[1]
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual([(c['tried'], c['matched'], c['fell_through']) for c in stats['clauses']],
+                         [(4, 1, 3), (3, 2, 1)])
+        self.assertTrue(all(c['guard_time'] >= 0 and c['body_time'] >= 0 for c in stats['clauses']))
+
+        @fpm.case
+        def sign(n):
+            return -1
+        sign(-1)
+        self.assertEqual([c['matched'] for c in sign.stats()[1]['clauses']], [1, 2, 1]) # kept after append
+
+        sign.enable_stats(False)
+        sign(-1)
+        self.assertEqual(sign.stats()[1]['clauses'][2]['matched'], 1)
+        sign.reset_stats()
+        self.assertEqual(sign.stats(), {})
+
+    def test_explain(self):
+        @fpm.case
+        def area(shape=fpm.isoftype(tuple) & fpm.seq('circle', fpm.bind('r', fpm.gt(0))), scale=fpm._,
+                 r=fpm._):
+            return 3 * r * r * scale
+
+        @fpm.case
+        @fpm.rguard(lambda shape, scale: scale > 0)
+        def area(shape, scale):
+            return 0
+
+        @fpm.case
+        def area(shape=fpm.each(fpm.isoftype(int)), scale=fpm._):
+            return sum(shape) * scale
+
+        try:
+            area(['circle', -1], 0)
+        except fpm.MatchError as e:
+            self.assertIs(e.func, area)
+            lines = e.explain().splitlines()
+        self.assertEqual(lines[0], "area(['circle', -1], 0): 3 clause(s) of arity 2")
+        self.assertTrue(lines[1].endswith(": shape = ['circle', -1] failed isoftype(%r)" % tuple)) # written order
+        self.assertTrue(lines[2].endswith(": relguard <lambda> rejected shape=['circle', -1], scale=0"))
+        self.assertTrue(lines[3].endswith(": shape[0] = 'circle' failed isoftype(%r)" % int))
+        self.assertEqual(lines[4], '  no clause matches')
+
+        lines = area.explain(('circle', -1), scale=2).splitlines()
+        self.assertTrue(lines[1].endswith(": shape[1] = -1 failed gt(0)"))
+        self.assertTrue(lines[2].endswith(": matches"))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(area.explain(('square',)).splitlines()[1], '  no clause matches')
+        self.assertIsNone(fpm.MatchError().explain())
+
+    def test_hooks(self):
+        @fpm.case
+        def size(n=fpm.gt(0), unit=fpm._):
+            return n
+
+        @fpm.case
+        @fpm.rguard(lambda n, unit: unit == 'inf')
+        def size(n, unit):
+            raise OverflowError(n)
+
+        events = []
+        def record(event):
+            callback = lambda *args: events.append((event,) + args)
+            fpm.add_hook(event, callback)
+            return event, callback
+        hooks = [record(event) for event in ('clause_selected', 'match_miss', 'clause_start', 'clause_end',
+                                             'guard_rejected', 'relguard_rejected')]
+        try:
+            self.assertEqual(size(2, 'm'), 2)
+            self.assertEqual([event[0] for event in events], ['clause_selected', 'clause_start', 'clause_end'])
+            self.assertIs(events[0][1], size)
+            self.assertEqual(events[0][3:], ((2, 'm'), {}))
+            self.assertIsNone(events[2][4])
+
+            del events[:]
+            self.assertRaises(OverflowError, size, -1, 'inf')
+            self.assertEqual(events[0][2:], ('n', -1))
+            self.assertEqual(events[0][1].__name__, 'size')
+            self.assertIsInstance(events[-1][4], OverflowError)
+
+            del events[:]
+            self.assertRaises(fpm.MatchError, size, -1, 'm')
+            self.assertEqual([event[0] for event in events], ['guard_rejected', 'relguard_rejected', 'match_miss'])
+            self.assertEqual(events[1][2], {'n': -1, 'unit': 'm'})
+        finally:
+            for event, callback in hooks:
+                fpm.remove_hook(event, callback)
+
+        # nothing is called once hooks are removed, not even `_emit`
+        del events[:]
+        self.assertRaises(fpm.MatchError, size, -1, 'm')
+        self.assertEqual(events, [])
+        self.assertFalse(any(name.startswith('_fpm_emit') for name in size.clauses[2][0]._matches.__code__.co_names))
+        self.assertRaises(ValueError, fpm.add_hook, 'clause', len)
+        self.assertRaises(ValueError, fpm.remove_hook, 'match_miss', len)
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            exporter = fpm.FileExporter(path, context=lambda: 'request-1').install()
+            size(1, 'm')
+            self.assertRaises(fpm.MatchError, size, -1, 'm')
+            exporter.uninstall()
+            with open(path) as events_file:
+                records = [json.loads(line) for line in events_file]
+            self.assertEqual([record['event'] for record in records],
+                             ['clause', 'guard_rejected', 'relguard_rejected', 'match_miss'])
+            self.assertEqual(records[0]['function'], 'size')
+            self.assertEqual(records[1]['argument'], 'n')
+            self.assertTrue(all(record['context'] == 'request-1' for record in records))
+
+            exporter = fpm.FileExporter(path, histograms=True, buckets=(1e-3, 10.0)).install()
+            for n in range(1, 4):
+                size(n, 'm')
+            exporter.uninstall()
+            with open(path) as metrics:
+                lines = metrics.read().splitlines()
+            self.assertIn('fpm_clause_duration_seconds_bucket{function="size",line="%i",le="+Inf"} 3'
+                          % fpm._clause_line(size.clauses[2][0]), lines)
+            self.assertIn('# TYPE fpm_match_misses_total counter', lines)
+        finally:
+            os.remove(path)
+        self.assertEqual(fpm._hooks, {})
+
+    def test_memoize(self):
+        calls = []
+
+        @fpm.case
+        def fib(n=0):
+            return 0
+
+        @fpm.case
+        def fib(n=1):
+            return 1
+
+        @fpm.case
+        @fpm.memoized(maxsize=4)
+        @fpm.guard(fpm.gt(1))
+        def fib(n):
+            calls.append(n)
+            return fib(n - 1) + fib(n - 2)
+
+        self.assertEqual(fib(30), 832040)
+        self.assertEqual(len(calls), 29) # each subcall computed once
+        self.assertEqual(fib(30), 832040)
+        self.assertEqual(len(calls), 29)
+        info = fib.cache_info()
+        self.assertEqual((info['maxsize'], info['size']), (4, 4))
+        self.assertEqual(info['misses'], 31)
+        self.assertEqual(info['hits'], 29)
+
+        fib(2)
+        self.assertEqual(calls[-1], 2) # evicted
+        fib.cache_clear()
+        fib(30)
+        self.assertEqual(len(calls), 59)
+
+        @fpm.dispatch
+        @fpm.memoized
+        def kind(n=bool):
+            return 'bool'
+
+        @fpm.dispatch
+        def kind(n=int):
+            return 'int'
+
+        self.assertEqual(kind(1), 'int')
+        self.assertEqual(kind(True), 'bool') # equal, but of different type
+        self.assertRaises(fpm.MatchError, kind, [1])
+        self.assertEqual(kind.cache_info()['unhashable'], 1)
+
+        @fpm.dispatch
+        def kind(n=list):
+            return 'list'
+        self.assertEqual(kind([1]), 'list')
+        self.assertEqual(kind.cache_info()['size'], 0) # emptied by append
+
+        kind.enable_memoize(False)
+        self.assertIs(kind.cache_info(), None)
+        kind.enable_decision_cache(maxsize=2)
+        self.assertEqual([kind(n) for n in (True, 1, True, [], 1)], ['bool', 'int', 'bool', 'list', 'int'])
+        self.assertRaises(ValueError, kind.enable_memoize, maxsize=0)
+
+        class Reentrant(object):
+            "Hashes and compares through the memoized function."
+            def __init__(self, n):
+                self.n = n
+            def __hash__(self):
+                return hash(size(self.n))
+            def __eq__(self, other):
+                return size(self.n) == size(other.n)
+            def __ne__(self, other):
+                return not self == other
+
+        @fpm.dispatch
+        @fpm.memoized
+        def size(n=int):
+            return n
+
+        @fpm.dispatch
+        def size(n=Reentrant):
+            return size(n.n) + 1
+
+        @fpm.dispatch
+        def size(n=object):
+            return sum(1 for _ in n)
+
+        self.assertEqual(size(Reentrant(3)), 4) # doesn't deadlock
+        self.assertEqual(size(Reentrant(3)), 4) # hit, comparing keys calls size too
+        self.assertEqual(size(iter([1, 2])), 2)
+        self.assertEqual(size.cache_info()['unhashable'], 1) # iterator
+
+    def test_decision_cache(self):
+        checked = []
+        handled = []
+
+        @fpm.makeguard
+        def known(inp):
+            checked.append(inp)
+            return inp in ('ping', 'pong')
+
+        @fpm.case
+        @fpm.guard(known, fpm._)
+        def handle(msg, body):
+            handled.append(msg)
+
+        @fpm.case
+        def handle(msg, body):
+            handled.append(None)
+
+        handle.enable_decision_cache(maxsize=2)
+        for msg in ('ping', 'foo', 'ping', 'foo', 'ping'):
+            handle(msg, 1)
+        self.assertEqual(checked, ['ping', 'foo']) # guards checked once per distinct arguments
+        self.assertEqual(handled, ['ping', None, 'ping', None, 'ping']) # body runs every time
+        handle('pong', body=1)
+        handle('pong', [1]) # unhashable, dispatched as usual
+        handle('pong', [1])
+        self.assertEqual(checked, ['ping', 'foo', 'pong', 'pong', 'pong'])
+
+        @fpm.case
+        def handle(msg, body, extra):
+            pass
+        handle('ping', 1) # cache emptied by append
+        self.assertEqual(checked[-1], 'ping')
+
+        handle.enable_decision_cache(False)
+        handle('ping', 1)
+        self.assertEqual(checked[-2:], ['ping', 'ping'])
+
+        # proxies equal to what they wrap, but reporting its class, are told apart by the class
+        class Proxy(object):
+            def __init__(self, wrapped):
+                self.wrapped = wrapped
+
+            @property
+            def __class__(self):
+                return type(self.wrapped)
+
+            def __eq__(self, other):
+                return self.wrapped == getattr(other, 'wrapped', other)
+
+            def __hash__(self):
+                return hash(self.wrapped)
+
+        @fpm.dispatch(bool)
+        def kind(obj):
+            return 'bool'
+
+        @fpm.dispatch(int)
+        def kind(obj):
+            return 'int'
+
+        kind.enable_decision_cache()
+        self.assertEqual([kind(Proxy(1)), kind(Proxy(True)), kind(obj=Proxy(1)), kind(obj=Proxy(True))],
+                         ['int', 'bool', 'int', 'bool'])
+
+        # equal arguments aren't the same object
+        sentinel = (1, 2)
+
+        @fpm.case
+        @fpm.guard(fpm.Is(sentinel))
+        def which(obj):
+            return 'sentinel'
+
+        @fpm.case
+        def which(obj):
+            return 'other'
+
+        which.enable_decision_cache()
+        self.assertEqual([which(sentinel), which(tuple([1, 2]))], ['sentinel', 'other'])
+
+        # iterators are consumed, so they're never looked up again
+        cache = fpm._DecisionCache(lambda args, kwargs: 'body', 8)
+        cache.select((iter([1]),), {})
+        cache.select((), {'items': (n for n in ())})
+        self.assertEqual(cache.bodies, {})
+
+    def test_tail_calls(self):
+        @fpm.case
+        @fpm.guard(fpm.eq(0), fpm._)
+        def total(n, acc):
+            return acc
+
+        @fpm.case
+        @fpm.tail_calls
+        @fpm.guard(fpm.gt(0), fpm._)
+        def total(n, acc):
+            return fpm.TailCall(total, n - 1, acc + n)
+
+        depth = sys.getrecursionlimit() * 10
+        self.assertEqual(total(depth, 0), depth * (depth + 1) // 2)
+        self.assertRaises(fpm.GuardError, total.clauses[2][1], -1, 0) # guards still checked on direct calls
+
+        @fpm.case
+        def is_even(n=0):
+            return True
+
+        @fpm.case
+        def is_even(n):
+            return fpm.TailCall(is_odd, n - 1)
+
+        @fpm.case
+        def is_odd(n=0):
+            return False
+
+        @fpm.case
+        def is_odd(n):
+            return fpm.TailCall(is_even, n - 1)
+
+        self.assertIsInstance(is_even(1), fpm.TailCall) # returned as is, unless enabled
+        is_even.enable_tail_calls()
+        self.assertFalse(is_even(depth + 1)) # calls to is_odd made by is_even's loop
+        self.assertEqual(is_even(3).__class__, bool)
+
+        @fpm.case
+        @fpm.tail_calls
+        def via_plain(n):
+            return fpm.TailCall(lambda n, acc: fpm.TailCall(total, n, acc=acc), n, acc=0)
+        self.assertEqual(via_plain(3), 6)
+
+        is_even.enable_tail_calls(False)
+        self.assertIsInstance(is_even(1), fpm.TailCall)
+
+    def test_concurrent_append(self):
+        import threading
+
+        @fpm.case
+        def code(n=0):
+            return 0
+
+        stop = threading.Event()
+        def call():
+            while not stop.is_set():
+                code(0)
+                code(1, 2) if 2 in code.clauses else None
+        callers = [threading.Thread(target=call) for _ in range(4)]
+        for thread in callers:
+            thread.start()
+        try:
+            for n in range(1, 200):
+                code.append(1, fpm.guard(fpm.eq(n))(lambda n: n))
+            code.append(2, fpm.guard(fpm.eq(1), fpm.eq(2))(lambda a, b: (a, b)))
+        finally:
+            stop.set()
+            for thread in callers:
+                thread.join()
+
+        self.assertEqual(len(code.clauses[1]), 200)
+        self.assertEqual([code(n) for n in range(200)], list(range(200))) # no selector built from old clauses
+        self.assertEqual(code(1, 2), (1, 2))
+
+    @unittest.skipIf(not py3, "no coroutines")
+    def test_async(self):
+        import asyncio, inspect
+        run = asyncio.run
+
+        self.assertTrue(inspect.iscoroutinefunction(greet))
+        self.assertEqual(run(greet('bob')), 'hi bob')
+        self.assertRaises(fpm.GuardError, run, greet(1)) # raised when awaited
+
+        self.assertTrue(run(known_user('alice')))
+        self.assertFalse(run((known_user & fpm.ne('alice'))('alice')))
+        self.assertEqual(run(sync_with_async_guard('alice')), 'alice')
+        self.assertRaises(fpm.GuardError, run, sync_with_async_guard('bob'))
+        self.assertEqual(run(differ(1, 2)), (1, 2))
+        self.assertIs(run(fpm.RelGuard(may_pass)(a=1, b=1, c=2)), False)
+        self.assertRaises(fpm.GuardError, run, differ(1, 1))
+
+        self.assertEqual(run(handle('alice')), 'known alice')
+        self.assertEqual(run(handle('root')), 'root') # sync clause result is returned by coroutine too
+        self.assertEqual(run(handle('eve')), 'stranger')
+        self.assertRaises(fpm.MatchError, handle, 'eve', 1) # no clauses of this arity, nothing to await
+
+class Benchmarks(unittest.TestCase):
+    def test_bench(self):
+        "Test that benchmarks run and results can be compared"
+
+        options = bench.parse_args(['--quick', '--clauses', '2', '4'])
+        options.min_time, options.repeat = 1e-4, 2
+        report = bench.run(bench._default_groups, options)
+        self.assertEqual(set(result['group'] for result in report['results']), set(bench._default_groups))
+        self.assertTrue(all(result['seconds'] > 0 for result in report['results']))
+        self.assertEqual(bench.compare(report, report, 0.0), [])
+
+        baseline = {'results': [dict(report['results'][0], seconds=report['results'][0]['seconds'] / 2)]}
+        self.assertEqual(bench.compare(report, baseline, 0.25), report['results'][:1])
+
 if __name__ == '__main__':
     unittest.main()